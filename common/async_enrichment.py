@@ -0,0 +1,291 @@
+import json
+import time
+import random
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager
+from urllib.parse import urlsplit
+
+from common.http_cache import OFFLINE_STATUS, add_cache_arguments, cache_key, open_cache
+
+DEFAULT_CONCURRENCY = 8
+DEFAULT_RATE_LIMIT = 5.0
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF = 1.0
+DEFAULT_TIMEOUT = 60
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class FetchError(Exception):
+    pass
+
+
+def import_aiohttp():
+    try:
+        import aiohttp
+    except ImportError:
+        raise ImportError(
+            "aiohttp is required for API enrichment. Install it with: pip install aiohttp")
+    return aiohttp
+
+
+class Response:
+    __slots__ = ('url', 'status', 'content', 'headers')
+
+    def __init__(self, url, status, content, headers=None):
+        self.url = url
+        self.status = status
+        self.content = content
+        self.headers = headers or {}
+
+    @property
+    def ok(self):
+        return self.status < 400
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8', errors='replace')
+
+    def json(self):
+        return json.loads(self.content)
+
+
+class StreamedResponse:
+    # Status and headers of a response whose body is read line by line with
+    # `async for line in response.lines`; lines are decoded, without newlines
+    __slots__ = ('url', 'status', 'headers', 'lines')
+
+    def __init__(self, url, status, headers, lines):
+        self.url = url
+        self.status = status
+        self.headers = headers
+        self.lines = lines
+
+    @property
+    def ok(self):
+        return self.status < 400
+
+
+async def content_lines(content):
+    for line in content.decode('utf-8', errors='replace').splitlines():
+        yield line
+
+
+async def response_lines(response, url):
+    aiohttp = import_aiohttp()
+    try:
+        async for line in response.content:
+            yield line.decode('utf-8', errors='replace').rstrip('\r\n')
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        raise FetchError(f"GET {url} failed while streaming: {e!r}") from e
+
+
+class HostRateLimiter:
+    # Spaces request starts at least 1/rate seconds apart for a single host
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate and rate > 0 else 0.0
+        self.next_start = 0.0
+        self.lock = asyncio.Lock()
+
+    async def wait(self):
+        if not self.interval:
+            return
+        async with self.lock:
+            now = time.monotonic()
+            delay = self.next_start - now
+            self.next_start = max(now, self.next_start) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+def retry_after(headers):
+    value = headers.get('Retry-After')
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+class EnrichmentEngine:
+    def __init__(self, concurrency=DEFAULT_CONCURRENCY, rate_limit=DEFAULT_RATE_LIMIT,
+                 host_rate_limits=None, retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF,
+                 timeout=DEFAULT_TIMEOUT, headers=None, cache=None):
+        self.concurrency = concurrency
+        self.rate_limit = rate_limit
+        self.host_rate_limits = dict(host_rate_limits or {})
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.headers = headers
+        self.cache = cache
+        self.limiters = {}
+        self.session = None
+        self.semaphore = None
+
+    async def __aenter__(self):
+        aiohttp = import_aiohttp()
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        connector = aiohttp.TCPConnector(limit=self.concurrency, keepalive_timeout=30)
+        self.session = aiohttp.ClientSession(
+            connector=connector, headers=self.headers,
+            timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.session.close()
+        if self.cache is not None:
+            print(f"Response cache: {self.cache.hits} hits, {self.cache.misses} misses")
+            self.cache.close()
+
+    def limiter(self, url):
+        host = urlsplit(url).hostname or ''
+        limiter = self.limiters.get(host)
+        if limiter is None:
+            limiter = HostRateLimiter(self.host_rate_limits.get(host, self.rate_limit))
+            self.limiters[host] = limiter
+        return limiter
+
+    async def fetch(self, url, params=None, method='GET', data=None):
+        if self.cache is None:
+            return await self.fetch_remote(url, params, method, data)
+        key = cache_key(method, url, params, data)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return Response(*cached)
+        if self.cache.offline:
+            return Response(url, OFFLINE_STATUS, b'', {})
+        response = await self.fetch_remote(url, params, method, data)
+        self.cache.put(key, response.url, response.status, response.content, response.headers)
+        return response
+
+    async def fetch_remote(self, url, params=None, method='GET', data=None):
+        # Retries connection errors, timeouts and RETRY_STATUSES with exponential
+        # backoff; after the last attempt the error or response is passed on
+        aiohttp = import_aiohttp()
+        limiter = self.limiter(url)
+        attempt = 0
+        while True:
+            delay = None
+            async with self.semaphore:
+                await limiter.wait()
+                try:
+                    async with self.session.request(method, url, params=params, data=data) as response:
+                        content = await response.read()
+                        result = Response(str(response.url), response.status,
+                                          content, dict(response.headers))
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    if attempt >= self.retries:
+                        raise FetchError(f"{method} {url} failed: {e!r}") from e
+                    result = None
+            if result is not None and (result.status not in RETRY_STATUSES or attempt >= self.retries):
+                return result
+            if result is not None:
+                delay = retry_after(result.headers)
+            if delay is None:
+                delay = self.backoff * (2 ** attempt) * (0.5 + random.random())
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    @asynccontextmanager
+    async def stream(self, url, params=None):
+        # GET whose body is read lazily: leaving the block before the last
+        # line closes the connection, so the rest of the body is never
+        # downloaded. The status is retried like fetch. With a cache the
+        # complete response is fetched and cached as usual, then replayed
+        # line by line, since a partly read body cannot be cached
+        if self.cache is not None:
+            response = await self.fetch(url, params)
+            yield StreamedResponse(response.url, response.status, response.headers,
+                                   content_lines(response.content))
+            return
+        aiohttp = import_aiohttp()
+        limiter = self.limiter(url)
+        attempt = 0
+        while True:
+            delay = None
+            async with self.semaphore:
+                await limiter.wait()
+                try:
+                    response = await self.session.get(url, params=params)
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    if attempt >= self.retries:
+                        raise FetchError(f"GET {url} failed: {e!r}") from e
+                    response = None
+                if response is not None:
+                    if response.status not in RETRY_STATUSES or attempt >= self.retries:
+                        try:
+                            yield StreamedResponse(str(response.url), response.status,
+                                                   dict(response.headers),
+                                                   response_lines(response, url))
+                        finally:
+                            if response.content.at_eof():
+                                response.release()
+                            else:
+                                response.close()
+                        return
+                    delay = retry_after(response.headers)
+                    response.release()
+            if delay is None:
+                delay = self.backoff * (2 ** attempt) * (0.5 + random.random())
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    async def map_ordered(self, items, handler, window=None):
+        # Runs handler(self, item) for up to `window` items at once and yields
+        # the results in input order
+        window = window or self.concurrency * 4
+        pending = deque()
+        try:
+            for item in items:
+                pending.append(asyncio.ensure_future(handler(self, item)))
+                if len(pending) >= window:
+                    yield await pending.popleft()
+            while pending:
+                yield await pending.popleft()
+        finally:
+            for task in pending:
+                task.cancel()
+
+
+def enrich_rows(rows, handler, consume, **engine_options):
+    # Synchronous entry point: consume(result) is called for each row's result,
+    # in input order, while later rows are still being fetched
+    async def run():
+        async with EnrichmentEngine(**engine_options) as engine:
+            async for result in engine.map_ordered(rows, handler):
+                consume(result)
+    asyncio.run(run())
+
+
+def parse_rate_limit(value):
+    host, separator, rate = value.rpartition('=')
+    if not separator or not host:
+        raise ValueError(f"Expected HOST=REQUESTS_PER_SECOND, got {value}")
+    return host, float(rate)
+
+
+def add_engine_arguments(parser, concurrency=DEFAULT_CONCURRENCY):
+    group = parser.add_argument_group('API requests')
+    group.add_argument('--concurrency', type=int, default=concurrency,
+                       help=f'Maximum number of requests in flight (default: {concurrency})')
+    group.add_argument('--rate_limit', action='append', default=[], metavar='HOST=RPS',
+                       type=parse_rate_limit,
+                       help='Requests per second allowed for a host, overriding the script default. Can be repeated')
+    group.add_argument('--retries', type=int, default=DEFAULT_RETRIES,
+                       help=f'Retries for failed requests, 429 and 5xx responses (default: {DEFAULT_RETRIES})')
+    group.add_argument('--timeout', type=float, default=DEFAULT_TIMEOUT,
+                       help=f'Per-request timeout in seconds (default: {DEFAULT_TIMEOUT})')
+    add_cache_arguments(parser)
+    return group
+
+
+def engine_options(args, host_rate_limits=None):
+    rate_limits = dict(host_rate_limits or {})
+    rate_limits.update(args.rate_limit)
+    return {
+        'concurrency': args.concurrency,
+        'host_rate_limits': rate_limits,
+        'retries': args.retries,
+        'timeout': args.timeout,
+        'cache': open_cache(args),
+    }
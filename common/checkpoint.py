@@ -0,0 +1,119 @@
+import os
+import json
+from itertools import islice
+
+DEFAULT_CHECKPOINT_EVERY = 100
+
+
+def journal_path(output_file):
+    return f"{output_file}.checkpoint"
+
+
+def input_signature(input_file):
+    return {'input': os.path.abspath(input_file), 'input_size': os.path.getsize(input_file)}
+
+
+def read_journal(path):
+    # Returns the metadata line and the last complete (rows_done, output_offset)
+    # entry; a line cut short by a crash is ignored
+    with open(path, 'r', encoding='utf-8') as f:
+        lines = f.read().split('\n')
+    meta = json.loads(lines[0])
+    rows_done, offset = 0, 0
+    for line in lines[1:-1]:
+        parts = line.split()
+        if len(parts) == 2 and all(part.isdigit() for part in parts):
+            rows_done, offset = int(parts[0]), int(parts[1])
+    return meta, rows_done, offset
+
+
+def saved_state(output_file):
+    # The `state` a previous run stored in its journal, {} if there is none
+    path = journal_path(output_file)
+    if not os.path.exists(path):
+        return {}
+    meta, _, _ = read_journal(path)
+    return meta.get('state', {})
+
+
+class Checkpoint:
+    # Journal of completed input rows for an output file written in input
+    # order. Every `every` rows the output is flushed and fsynced, then the
+    # row count and output size are appended to <output>.checkpoint. With
+    # resume=True the output is truncated back to the last recorded size,
+    # reopened for appending and the rows already written are skipped.
+    # `state` is a JSON-serializable dict kept in the journal's metadata line,
+    # for anything else a resumed run must reuse, such as a file name.
+    def __init__(self, output_file, input_file, resume=False, every=DEFAULT_CHECKPOINT_EVERY,
+                 state=None, **open_kwargs):
+        self.output_file = output_file
+        self.path = journal_path(output_file)
+        self.every = max(1, every)
+        self.rows_done = 0
+        self.offset = 0
+        signature = input_signature(input_file)
+        if resume and os.path.exists(self.path) and os.path.exists(output_file):
+            meta, self.rows_done, self.offset = read_journal(self.path)
+            if {key: meta.get(key) for key in signature} != signature:
+                raise ValueError(
+                    f"{self.path} was written for a different input ({meta['input']}, {meta['input_size']} bytes)")
+        if self.offset:
+            os.truncate(output_file, self.offset)
+            self.output = open(output_file, 'a', **open_kwargs)
+            self.journal = open(self.path, 'a', encoding='utf-8')
+            print(f"Resuming after {self.rows_done} rows already written to {output_file}")
+        else:
+            self.rows_done = 0
+            self.output = open(output_file, 'w', **open_kwargs)
+            self.journal = open(self.path, 'w', encoding='utf-8')
+            self.journal.write(json.dumps({**signature, 'state': state} if state else signature) + '\n')
+            self.journal.flush()
+        self.recorded = self.rows_done
+
+    @property
+    def needs_header(self):
+        return self.offset == 0
+
+    def skip(self, rows):
+        return islice(rows, self.rows_done, None)
+
+    def row_writer(self, writer):
+        def write_row(row):
+            writer.writerow(row)
+            self.record()
+        return write_row
+
+    def record(self):
+        self.rows_done += 1
+        if self.rows_done - self.recorded >= self.every:
+            self.commit()
+
+    def commit(self):
+        self.output.flush()
+        os.fsync(self.output.fileno())
+        self.offset = self.output.tell()
+        self.journal.write(f"{self.rows_done} {self.offset}\n")
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+        self.recorded = self.rows_done
+
+    def close(self):
+        if not self.output.closed:
+            self.commit()
+            self.output.close()
+            self.journal.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def add_checkpoint_arguments(parser):
+    group = parser.add_argument_group('Checkpointing')
+    group.add_argument('--resume', action='store_true',
+                       help='Continue an interrupted run from its checkpoint journal instead of starting over')
+    group.add_argument('--checkpoint_every', type=int, default=DEFAULT_CHECKPOINT_EVERY,
+                       help=f'Rows written between checkpoints (default: {DEFAULT_CHECKPOINT_EVERY})')
+    return group
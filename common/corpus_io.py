@@ -0,0 +1,104 @@
+import csv
+from datetime import datetime
+
+PARQUET_EXTENSIONS = ('.parquet', '.pq')
+READ_BATCH_SIZE = 65536
+
+
+def is_parquet(file_path):
+    return file_path.lower().endswith(PARQUET_EXTENSIONS)
+
+
+def import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError(
+            "pyarrow is required to read or write Parquet files. Install it with: pip install pyarrow")
+    return pyarrow
+
+
+def check_columns(available, columns):
+    for column in columns or []:
+        if column not in available:
+            raise KeyError(column)
+
+
+def read_fieldnames(file_path):
+    if is_parquet(file_path):
+        pa = import_pyarrow()
+        return pa.parquet.ParquetFile(file_path).schema_arrow.names
+    with open(file_path, 'r', encoding='utf-8', newline='') as f:
+        return next(csv.reader(f), [])
+
+
+def to_strings(values):
+    # Strings as csv.DictReader would give them: '' for nulls, and timestamps
+    # as datetime.isoformat() text of the stored UTC value. That text is
+    # normalized, e.g. 2024-01-01T00:00:00.123000+00:00 for a CSV value of
+    # 2024-01-01T00:00:00.123Z, so it need not match the source CSV string
+    return [value.isoformat() if isinstance(value, datetime) else ('' if value is None else value)
+            for value in values]
+
+
+def iter_parquet_rows(file_path, columns=None, batch_size=READ_BATCH_SIZE):
+    pa = import_pyarrow()
+    parquet_file = pa.parquet.ParquetFile(file_path)
+    check_columns(parquet_file.schema_arrow.names, columns)
+    for batch in parquet_file.iter_batches(batch_size=batch_size, columns=columns):
+        names = batch.schema.names
+        values = [to_strings(column.to_pylist()) for column in batch.columns]
+        for row in zip(*values):
+            yield dict(zip(names, row))
+
+
+def iter_rows(file_path, columns=None):
+    # Parquet files are read with column projection; CSV rows always carry every column
+    if is_parquet(file_path):
+        yield from iter_parquet_rows(file_path, columns)
+        return
+    with open(file_path, 'r', encoding='utf-8', newline='') as f:
+        reader = csv.DictReader(f)
+        check_columns(reader.fieldnames or [], columns)
+        yield from reader
+
+
+def normalize_parquet_frame(df):
+    import pandas as pd
+    # Close to pd.read_csv: empty strings as missing values, and timestamps as
+    # normalized ISO 8601 text (see to_strings), not the source CSV strings
+    for column in df.columns:
+        dtype = df[column].dtype
+        if isinstance(dtype, pd.DatetimeTZDtype):
+            df[column] = df[column].map(
+                lambda value: value.isoformat() if pd.notna(value) else None)
+        elif isinstance(dtype, pd.CategoricalDtype):
+            if '' in dtype.categories:
+                df[column] = df[column].cat.remove_categories([''])
+        elif dtype == object:
+            df[column] = df[column].mask(df[column] == '')
+    return df
+
+
+def read_dataframe(file_path, columns=None, **read_csv_kwargs):
+    import pandas as pd
+    if not is_parquet(file_path):
+        return pd.read_csv(file_path, usecols=columns, **read_csv_kwargs)
+    import_pyarrow()
+    return normalize_parquet_frame(pd.read_parquet(file_path, columns=columns))
+
+
+def iter_dataframes(file_path, columns=None, chunk_size=READ_BATCH_SIZE, **read_csv_kwargs):
+    # Chunked read_dataframe; read_csv_kwargs only apply to CSV input, Parquet
+    # dictionary columns already come back as categoricals
+    import pandas as pd
+    if not is_parquet(file_path):
+        with pd.read_csv(file_path, usecols=columns, chunksize=chunk_size, **read_csv_kwargs) as reader:
+            yield from reader
+        return
+    pa = import_pyarrow()
+    parquet_file = pa.parquet.ParquetFile(file_path)
+    check_columns(parquet_file.schema_arrow.names, columns)
+    for batch in parquet_file.iter_batches(batch_size=chunk_size, columns=columns):
+        yield normalize_parquet_frame(batch.to_pandas())
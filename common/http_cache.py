@@ -0,0 +1,145 @@
+import json
+import time
+import sqlite3
+import hashlib
+from urllib.parse import urlencode
+
+DEFAULT_NEGATIVE_TTL = 7 * 24 * 3600
+COMMIT_INTERVAL = 100
+EVICTION_TARGET = 0.9
+OFFLINE_STATUS = 504
+
+
+def cache_key(method, url, params=None, data=None):
+    if params:
+        items = params.items() if hasattr(params, 'items') else params
+        url = f"{url}{'&' if '?' in url else '?'}{urlencode(sorted(items))}"
+    digest = hashlib.sha256(f"{method.upper()} {url}".encode('utf-8'))
+    if data:
+        digest.update(b'\0')
+        digest.update(data if isinstance(data, bytes) else str(data).encode('utf-8'))
+    return digest.hexdigest()
+
+
+class ResponseCache:
+    # Single-file sqlite store of HTTP responses keyed by method, URL, query
+    # parameters and body. Successful responses live for `ttl` seconds (None
+    # keeps them forever), 404s for `negative_ttl` (0 disables negative
+    # caching), and the least recently used entries are evicted once the
+    # stored content exceeds `max_bytes`. In offline mode entries never expire
+    # and misses are answered with a 504 instead of going to the network.
+    def __init__(self, path, ttl=None, negative_ttl=DEFAULT_NEGATIVE_TTL,
+                 max_bytes=None, offline=False):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self.hits = 0
+        self.misses = 0
+        self.pending = 0
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS responses (
+            key TEXT PRIMARY KEY, url TEXT, status INTEGER, headers TEXT,
+            content BLOB, size INTEGER, stored_at REAL, accessed_at REAL)''')
+        self.connection.execute(
+            'CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed_at)')
+        self.total_bytes = self.connection.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        if self.max_bytes is not None and self.total_bytes > self.max_bytes:
+            self.evict()
+            self.connection.commit()
+
+    def expired(self, status, stored_at, now):
+        if self.offline:
+            return False
+        ttl = self.negative_ttl if status == 404 else self.ttl
+        return ttl is not None and now - stored_at > ttl
+
+    def get(self, key):
+        row = self.connection.execute(
+            'SELECT url, status, headers, content, stored_at FROM responses WHERE key = ?',
+            (key,)).fetchone()
+        now = time.time()
+        if row is None or self.expired(row[1], row[4], now):
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.connection.execute(
+            'UPDATE responses SET accessed_at = ? WHERE key = ?', (now, key))
+        self.mark_dirty()
+        url, status, headers, content, _ = row
+        return url, status, content, json.loads(headers)
+
+    def cacheable(self, status):
+        return 200 <= status < 300 or (status == 404 and self.negative_ttl != 0)
+
+    def put(self, key, url, status, content, headers):
+        if self.offline or not self.cacheable(status):
+            return
+        size = len(content)
+        now = time.time()
+        previous = self.connection.execute(
+            'SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+        self.connection.execute(
+            'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (key, url, status, json.dumps(dict(headers)), content, size, now, now))
+        self.total_bytes += size - (previous[0] if previous else 0)
+        if self.max_bytes is not None and self.total_bytes > self.max_bytes:
+            self.evict()
+        self.mark_dirty()
+
+    def evict(self):
+        target = self.max_bytes * EVICTION_TARGET
+        evicted = []
+        for key, size in self.connection.execute(
+                'SELECT key, size FROM responses ORDER BY accessed_at'):
+            if self.total_bytes <= target:
+                break
+            evicted.append((key,))
+            self.total_bytes -= size
+        self.connection.executemany('DELETE FROM responses WHERE key = ?', evicted)
+
+    def mark_dirty(self):
+        self.pending += 1
+        if self.pending >= COMMIT_INTERVAL:
+            self.connection.commit()
+            self.pending = 0
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+
+def parse_size(value):
+    units = {'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+    value = value.strip().lower().rstrip('b')
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+
+def add_cache_arguments(parser):
+    group = parser.add_argument_group('Response cache')
+    group.add_argument('--cache',
+                       help='sqlite file caching API responses between runs (disabled when not given)')
+    group.add_argument('--cache_ttl', type=float,
+                       help='Seconds before a cached response is fetched again (default: never)')
+    group.add_argument('--cache_negative_ttl', type=float, default=DEFAULT_NEGATIVE_TTL,
+                       help=f'Seconds a cached 404 is trusted, 0 to never cache 404s (default: {DEFAULT_NEGATIVE_TTL})')
+    group.add_argument('--cache_max_size', type=parse_size,
+                       help='Evict least recently used responses above this size, e.g. 500M or 2G (default: unlimited)')
+    group.add_argument('--offline', action='store_true',
+                       help='Replay responses from --cache only; uncached requests get a 504 and nothing is fetched')
+    return group
+
+
+def open_cache(args):
+    if args.offline and not args.cache:
+        raise ValueError('--offline requires --cache')
+    if not args.cache:
+        return None
+    return ResponseCache(args.cache, ttl=args.cache_ttl,
+                         negative_ttl=args.cache_negative_ttl,
+                         max_bytes=args.cache_max_size, offline=args.offline)
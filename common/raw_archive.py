@@ -0,0 +1,96 @@
+import os
+import gzip
+
+COMPRESS_LEVEL = 6
+
+
+def index_path(path):
+    return f"{path}.idx"
+
+
+def read_index(path):
+    # accession -> (offset, length) of its gzip member; a later entry for the
+    # same accession replaces the earlier one, and a line cut short by a
+    # crash is ignored
+    index = {}
+    if not os.path.exists(path):
+        return index
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            parts = line.rstrip('\n').split('\t')
+            if len(parts) == 3 and line.endswith('\n'):
+                index[parts[0]] = (int(parts[1]), int(parts[2]))
+    return index
+
+
+class RawArchive:
+    # Appendable archive of raw responses in one file. Each response is
+    # compressed as its own gzip member and appended to `path`, so the whole
+    # file is still a valid gzip stream (zcat works on it), and `path`.idx
+    # holds one "accession<TAB>offset<TAB>length" line per member for random
+    # access. The index is written after the member, and on reopening any
+    # bytes past the last indexed member are cut off, so a crash never leaves
+    # a record the index cannot account for. A non-empty file without index
+    # entries is refused instead.
+    def __init__(self, path, mode='a'):
+        if mode not in ('a', 'r'):
+            raise ValueError(f"mode must be 'a' or 'r', not {mode!r}")
+        self.path = path
+        self.mode = mode
+        self.index = read_index(index_path(path))
+        end = max((offset + length for offset, length in self.index.values()), default=0)
+        if mode == 'r':
+            self.data = open(path, 'rb')
+            self.index_file = None
+            return
+        if os.path.exists(path) and os.path.getsize(path) > end:
+            # Without an index nothing tells which bytes are complete
+            # records, so the file is left alone rather than emptied
+            if not self.index:
+                raise ValueError(f"{path} is not empty but its index {index_path(path)} "
+                                 "is missing or empty; restore the index or move the file away")
+            os.truncate(path, end)
+        self.data = open(path, 'ab')
+        self.index_file = open(index_path(path), 'a', encoding='utf-8')
+
+    def add(self, accession, text):
+        member = gzip.compress(text.encode('utf-8'), compresslevel=COMPRESS_LEVEL)
+        offset = self.data.tell()
+        self.data.write(member)
+        self.data.flush()
+        self.index_file.write(f"{accession}\t{offset}\t{len(member)}\n")
+        self.index_file.flush()
+        self.index[accession] = (offset, len(member))
+
+    def get(self, accession):
+        offset, length = self.index[accession]
+        if self.mode == 'a':
+            with open(self.path, 'rb') as f:
+                f.seek(offset)
+                member = f.read(length)
+        else:
+            self.data.seek(offset)
+            member = self.data.read(length)
+        return gzip.decompress(member).decode('utf-8')
+
+    def __contains__(self, accession):
+        return accession in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def __iter__(self):
+        # (accession, text) in archive order
+        for accession, _ in sorted(self.index.items(), key=lambda item: item[1][0]):
+            yield accession, self.get(accession)
+
+    def close(self):
+        self.data.close()
+        if self.index_file is not None:
+            self.index_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,211 @@
+import re
+import json
+import math
+import zipfile
+import unicodedata
+from array import array
+from collections import defaultdict
+
+MIN_CHOSEN_SCORE = 0.9
+MAX_CANDIDATES = 25
+# Tokens carried by more names than this ("university", "institute", ...)
+# are too common to pick candidates by, though they still count in scoring
+MAX_POSTINGS = 2000
+STOPWORDS = {'of', 'the', 'and', 'for', 'at', 'in', 'de', 'du', 'des', 'la', 'le', 'di', 'del',
+             'der', 'und', 'fur', 'y', 'e'}
+ABBREVIATIONS = {
+    'univ': 'university', 'universite': 'university', 'universitat': 'university',
+    'universidad': 'university', 'universita': 'university', 'inst': 'institute',
+    'dept': 'department', 'natl': 'national', 'ctr': 'center', 'centre': 'center',
+    'hosp': 'hospital', 'acad': 'academy', 'lab': 'laboratory', 'labs': 'laboratories',
+    'st': 'saint',
+}
+COUNTRY_ALIASES = {
+    'usa': 'US', 'us': 'US', 'united states of america': 'US', 'uk': 'GB',
+    'england': 'GB', 'scotland': 'GB', 'wales': 'GB', 'northern ireland': 'GB',
+    'great britain': 'GB', 'south korea': 'KR', 'korea': 'KR', 'republic of korea': 'KR',
+    'russia': 'RU', 'pr china': 'CN', 'peoples r china': 'CN', 'the netherlands': 'NL',
+    'holland': 'NL', 'czech republic': 'CZ', 'iran': 'IR', 'taiwan': 'TW', 'vietnam': 'VN',
+}
+
+
+def normalize_text(text):
+    # Lower case ASCII tokens with accents folded, punctuation removed and
+    # common abbreviations expanded
+    text = unicodedata.normalize('NFKD', text)
+    text = ''.join(c for c in text if not unicodedata.combining(c)).casefold()
+    tokens = re.sub(r'[\W_]+', ' ', text).split()
+    return ' '.join(ABBREVIATIONS.get(token, token) for token in tokens)
+
+
+def name_key(text):
+    # Comparison form of a name: normalized, without stopwords
+    tokens = [token for token in normalize_text(text).split() if token not in STOPWORDS]
+    return ' '.join(tokens)
+
+
+def trigrams(key):
+    padded = f"  {key} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def similarity(key, other):
+    if key == other:
+        return 1.0
+    a, b = trigrams(key), trigrams(other)
+    return 2 * len(a & b) / (len(a) + len(b))
+
+
+def split_affiliation(affiliation):
+    return [part.strip() for part in re.split(r'[,;|]', affiliation) if part.strip()]
+
+
+def v1_record(record):
+    names = [record.get('name', '')] + record.get('aliases', []) + \
+        [label.get('label', '') for label in record.get('labels', [])]
+    country = record.get('country') or {}
+    return (record['id'], record.get('status', 'active'), names, record.get('acronyms', []),
+            country.get('country_code'), country.get('country_name'))
+
+
+def v2_record(record):
+    names, acronyms = [], []
+    for name in record.get('names', []):
+        (acronyms if 'acronym' in name.get('types', []) else names).append(name.get('value', ''))
+    country_code = country_name = None
+    for location in record.get('locations', []):
+        details = location.get('geonames_details') or {}
+        country_code, country_name = details.get('country_code'), details.get('country_name')
+        break
+    return (record['id'], record.get('status', 'active'), names, acronyms, country_code, country_name)
+
+
+def read_dump(path):
+    # Accepts a ROR data dump as .json or as the .zip it is published in. For
+    # zips holding both schema versions the v2 file is used
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as archive:
+            members = [name for name in archive.namelist() if name.endswith('.json')]
+            if not members:
+                raise ValueError(f"No JSON file found in {path}")
+            member = next((name for name in members if 'schema_v2' in name), members[0])
+            with archive.open(member) as f:
+                records = json.load(f)
+    else:
+        with open(path, 'r', encoding='utf-8') as f:
+            records = json.load(f)
+    for record in records:
+        yield v2_record(record) if 'names' in record else v1_record(record)
+
+
+class LocalRORMatcher:
+    # In-memory affiliation matcher over a ROR data dump, standing in for the
+    # ROR affiliation API's "chosen" result. Names, aliases and labels are
+    # indexed by token; each comma separated part of an affiliation gathers
+    # candidates through its rarer tokens, restricted to the country named in
+    # the affiliation when there is one, and is scored against them by
+    # character trigram similarity. A match is chosen when the best score is
+    # at least MIN_CHOSEN_SCORE and no other organization ties it. A part
+    # that is exactly an acronym is chosen only for a single organization in
+    # the named country.
+    def __init__(self, records):
+        self.ids = []
+        self.countries = []
+        self.keys = []
+        self.key_orgs = array('i')
+        self.exact = defaultdict(list)
+        self.acronyms = defaultdict(list)
+        self.country_codes = dict(COUNTRY_ALIASES)
+        postings = defaultdict(list)
+        for ror_id, status, names, acronyms, country_code, country_name in records:
+            if status == 'withdrawn':
+                continue
+            org = len(self.ids)
+            self.ids.append(ror_id)
+            self.countries.append(country_code)
+            if country_code and country_name:
+                self.country_codes.setdefault(normalize_text(country_name), country_code)
+            for key in dict.fromkeys(name_key(name) for name in names):
+                if not key:
+                    continue
+                index = len(self.keys)
+                self.keys.append(key)
+                self.key_orgs.append(org)
+                self.exact[key].append(index)
+                for token in set(key.split()):
+                    postings[token].append(index)
+            for acronym in acronyms:
+                self.acronyms[acronym.strip()].append(org)
+        self.postings = {token: array('i', indexes) for token, indexes in postings.items()}
+        self.weights = {token: math.log(len(self.keys) / len(indexes))
+                        for token, indexes in self.postings.items()}
+
+    @classmethod
+    def from_dump(cls, path):
+        return cls(read_dump(path))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def detect_country(self, parts):
+        for part in reversed(parts):
+            code = self.country_codes.get(normalize_text(part))
+            if code:
+                return code
+        return None
+
+    def candidate_keys(self, key):
+        found = dict.fromkeys(self.exact.get(key, ()), math.inf)
+        weights = defaultdict(float)
+        for token in set(key.split()):
+            indexes = self.postings.get(token)
+            if indexes is not None and len(indexes) <= MAX_POSTINGS:
+                weight = self.weights[token]
+                for index in indexes:
+                    weights[index] += weight
+        for index in sorted(weights, key=weights.get, reverse=True)[:MAX_CANDIDATES]:
+            found.setdefault(index, weights[index])
+        return found
+
+    def scored_candidates(self, affiliation):
+        # (score, part length, organization) for each candidate of each part
+        parts = split_affiliation(affiliation)
+        country = self.detect_country(parts)
+        scored = {}
+        for part in parts:
+            key = name_key(part)
+            if not key or self.country_codes.get(normalize_text(part)):
+                continue
+            for index in self.candidate_keys(key):
+                org = self.key_orgs[index]
+                if country and self.countries[org] != country:
+                    continue
+                score = (similarity(key, self.keys[index]), len(key.split()))
+                if score > scored.get(org, (0.0, 0)):
+                    scored[org] = score
+        return country, parts, scored
+
+    def match(self, affiliation):
+        # ROR ID of the chosen organization for an affiliation string, or None
+        if not affiliation or not re.search(r"[a-zA-Z]", affiliation):
+            return None
+        country, parts, scored = self.scored_candidates(affiliation)
+        if scored:
+            best = max(scored.values())
+            orgs = [org for org, score in scored.items() if score == best]
+            if best[0] >= MIN_CHOSEN_SCORE and len(orgs) == 1:
+                return self.ids[orgs[0]]
+        if country:
+            for part in parts:
+                orgs = [org for org in self.acronyms.get(part, ())
+                        if self.countries[org] == country]
+                if len(orgs) == 1:
+                    return self.ids[orgs[0]]
+        return None
+
+    def candidates(self, affiliation, limit=5):
+        # Best scoring organizations, for inspecting why a match was or was
+        # not chosen
+        _, _, scored = self.scored_candidates(affiliation)
+        ranked = sorted(scored.items(), key=lambda item: item[1], reverse=True)[:limit]
+        return [(self.ids[org], score) for org, (score, _) in ranked]
@@ -0,0 +1,106 @@
+import re
+import asyncio
+from collections import OrderedDict
+
+from common.ror_local import LocalRORMatcher
+
+ROR_URL = "https://api.ror.org/organizations"
+DEFAULT_MEMORY_SIZE = 100000
+
+
+def normalize_affiliation(affiliation):
+    # Query text sent to ROR, or None when there is nothing to match. Only
+    # characters the affiliation endpoint chokes on and runs of whitespace are
+    # removed; case is kept because ROR reads upper case tokens as acronyms
+    if affiliation is None or not re.search(r"[a-zA-Z]", affiliation):
+        return None
+    affiliation = re.sub(r'[{."\\]', "", affiliation)
+    return ' '.join(affiliation.split())
+
+
+def chosen_ror_id(data):
+    for matched_org in data["items"]:
+        if matched_org["chosen"]:
+            return matched_org["organization"]["id"]
+    return None
+
+
+class RORResolver:
+    # Resolves affiliation strings to ROR IDs through an EnrichmentEngine.
+    # Answers are memoized per normalized string in an LRU of `memory_size`
+    # entries, and concurrent lookups of the same string share one request,
+    # so each distinct affiliation is requested once per run. Across runs the
+    # engine's response cache (--cache) plays the same role. With a
+    # LocalRORMatcher, affiliations are matched against a ROR data dump in
+    # memory and nothing is sent to the API.
+    def __init__(self, memory_size=DEFAULT_MEMORY_SIZE, matcher=None):
+        self.memory_size = memory_size
+        self.matcher = matcher
+        self.memory = OrderedDict()
+        self.in_flight = {}
+        self.lookups = 0
+        self.requests = 0
+
+    def remember(self, query, ror_id):
+        self.memory[query] = ror_id
+        if len(self.memory) > self.memory_size:
+            self.memory.popitem(last=False)
+
+    async def lookup(self, engine, query):
+        self.requests += 1
+        response = await engine.fetch(ROR_URL, {"affiliation": query})
+        if response.status != 200:
+            return None
+        ror_id = chosen_ror_id(response.json())
+        self.remember(query, ror_id)
+        return ror_id
+
+    async def resolve(self, engine, affiliation):
+        query = normalize_affiliation(affiliation)
+        if query is None:
+            return None
+        self.lookups += 1
+        if query in self.memory:
+            self.memory.move_to_end(query)
+            return self.memory[query]
+        if self.matcher is not None:
+            self.requests += 1
+            ror_id = self.matcher.match(query)
+            self.remember(query, ror_id)
+            return ror_id
+        task = self.in_flight.get(query)
+        if task is None:
+            task = asyncio.ensure_future(self.lookup(engine, query))
+            self.in_flight[query] = task
+            task.add_done_callback(lambda _: self.in_flight.pop(query, None))
+        return await asyncio.shield(task)
+
+    async def resolve_all(self, engine, affiliations):
+        # Looks up the distinct affiliations concurrently and returns a dict
+        # from each given string to its ROR ID (or None)
+        distinct = list(dict.fromkeys(affiliations))
+        ror_ids = await asyncio.gather(*(self.resolve(engine, affiliation)
+                                         for affiliation in distinct))
+        return dict(zip(distinct, ror_ids))
+
+    def summary(self):
+        if self.matcher is not None:
+            return (f"ROR: {self.lookups} affiliation lookups, "
+                    f"{self.requests} distinct affiliations matched locally")
+        return (f"ROR: {self.lookups} affiliation lookups, "
+                f"{self.requests} distinct affiliations requested")
+
+
+def add_ror_arguments(parser):
+    group = parser.add_argument_group('ROR matching')
+    group.add_argument('--ror_dump',
+                       help='ROR data dump (.json or .zip) to match affiliations against locally instead of calling the ROR API')
+    return group
+
+
+def open_resolver(args):
+    if not args.ror_dump:
+        return RORResolver()
+    matcher = LocalRORMatcher.from_dump(args.ror_dump)
+    print(f"Loaded {len(matcher)} ROR organizations from {args.ror_dump}")
+    return RORResolver(matcher=matcher)
@@ -1,11 +1,19 @@
 import os
+import sys
 import csv
 import json
 import argparse
-import requests
-from time import sleep
 from collections import defaultdict
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from common.checkpoint import DEFAULT_CHECKPOINT_EVERY, Checkpoint, add_checkpoint_arguments
+from common.async_enrichment import add_engine_arguments, engine_options, enrich_rows
+
+# NCBI allows 3 requests per second without an API key
+RATE_LIMITS = {
+    'api.ncbi.nlm.nih.gov': 3,
+}
+
 
 def parse_arguments():
     parser = argparse.ArgumentParser(
@@ -13,13 +21,15 @@ def parse_arguments():
     parser.add_argument('-i', '--input_file',
                         required=True, help='Input CSV file')
     parser.add_argument('-o', '--output_file', help='Output CSV file')
+    add_engine_arguments(parser)
+    add_checkpoint_arguments(parser)
     return parser.parse_args()
 
 
-def query_api(subj_id):
+async def query_api(engine, subj_id):
     url = f"https://api.ncbi.nlm.nih.gov/variation/v0/refsnp/{subj_id.lstrip('rs')}"
-    response = requests.get(url)
-    return url, response.ok, response.status_code, response.json() if response.ok else None
+    response = await engine.fetch(url)
+    return url, response.ok, response.status, response.json() if response.ok else None
 
 
 def extract_citation_ids(data):
@@ -35,26 +45,30 @@ def extract_submitter_handles(data):
     return ';'.join(sorted(handles))
 
 
-def process_and_write(input_file, output_file):
-    with open(input_file, 'r') as infile, open(output_file, 'w', newline='') as outfile:
+async def enrich_row(engine, row):
+    subj_id = row['subjId']
+    url, valid_response, response_code, data = await query_api(engine, subj_id)
+    row.update({
+        'API_URL': url,
+        'Valid_Response': valid_response,
+        'Response_Code': response_code,
+        'Citation_IDs': extract_citation_ids(data) if data else '',
+        'Submitter_Handles': extract_submitter_handles(data) if data else ''
+    })
+    return row
+
+
+def process_and_write(input_file, output_file, options, resume=False, checkpoint_every=DEFAULT_CHECKPOINT_EVERY):
+    with open(input_file, 'r') as infile, \
+            Checkpoint(output_file, input_file, resume, checkpoint_every, newline='') as checkpoint:
         reader = csv.DictReader(infile)
         fieldnames = reader.fieldnames + \
             ['API_URL', 'Valid_Response', 'Response_Code',
                 'Citation_IDs', 'Submitter_Handles']
-        writer = csv.DictWriter(outfile, fieldnames=fieldnames)
-        writer.writeheader()
-        for row in reader:
-            subj_id = row['subjId']
-            url, valid_response, response_code, data = query_api(subj_id)
-            row.update({
-                'API_URL': url,
-                'Valid_Response': valid_response,
-                'Response_Code': response_code,
-                'Citation_IDs': extract_citation_ids(data) if data else '',
-                'Submitter_Handles': extract_submitter_handles(data) if data else ''
-            })
-            writer.writerow(row)
-            sleep(1)
+        writer = csv.DictWriter(checkpoint.output, fieldnames=fieldnames)
+        if checkpoint.needs_header:
+            writer.writeheader()
+        enrich_rows(checkpoint.skip(reader), enrich_row, checkpoint.row_writer(writer), **options)
 
 
 def main():
@@ -64,7 +78,8 @@ def main():
     else:
         input_file_base = os.path.splitext(args.input_file)[0]
         output_file = f"{input_file_base}_w_dbSNP_data.csv"
-    process_and_write(args.input_file, output_file)
+    process_and_write(args.input_file, output_file, engine_options(args, RATE_LIMITS),
+                      args.resume, args.checkpoint_every)
     print(f"Processing complete. Results written to {output_file}")
 
 
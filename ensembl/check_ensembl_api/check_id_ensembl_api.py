@@ -1,18 +1,34 @@
 import re
 import csv
+import time
 import requests
 import argparse
 from itertools import islice
 from urllib.parse import quote, urlparse
 from multiprocessing import Pool, cpu_count
 
+ENSEMBL_SERVER = "https://rest.ensembl.org"
+MAX_BATCH_SIZE = 1000
+BATCH_RETRIES = 3
+BACKOFF_SECONDS = 1
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+session = None
+
 
 def parse_arguments():
     parser = argparse.ArgumentParser(
         description='Validate subject IDs from CSV using BioStudies API')
     parser.add_argument('-i', '--input_file', help='Input CSV file path')
     parser.add_argument('-o', '--output_file', help='Output CSV file path')
-    return parser.parse_args()
+    parser.add_argument('-b', '--batch_size', type=int, default=0,
+                        help=f'IDs per POST /archive/id request, up to {MAX_BATCH_SIZE}; 0 sends one GET per ID (default: 0)')
+    parser.add_argument('-w', '--workers', type=int, default=min(5, cpu_count()),
+                        help='Number of worker processes sending requests (default: min(5, CPUs))')
+    args = parser.parse_args()
+    if not 0 <= args.batch_size <= MAX_BATCH_SIZE:
+        parser.error(f'--batch_size must be between 0 and {MAX_BATCH_SIZE}')
+    return args
 
 
 def extract_id(value):
@@ -23,34 +39,111 @@ def extract_id(value):
     return value
 
 
+def get_session():
+    # One keep-alive session per worker process
+    global session
+    if session is None:
+        session = requests.Session()
+    return session
+
+
+def is_transient(error):
+    # Connection errors, 429 and 5xx may succeed when asked again; other
+    # HTTP errors, such as the 400 for an unknown ID, are final answers
+    response = getattr(error, 'response', None)
+    return response is None or response.status_code in RETRY_STATUSES or response.status_code >= 500
+
+
 def query_api(subj_id):
-    url = f"https://rest.ensembl.org/archive/id/{quote(subj_id)}?content-type=application/json"
+    # (api_status, error_message, whether the answer is a transient failure)
+    url = f"{ENSEMBL_SERVER}/archive/id/{quote(subj_id)}?content-type=application/json"
     try:
-        response = requests.get(url)
+        response = get_session().get(url)
         response.raise_for_status()
         json_response = response.json()
         if 'errorMessage' in json_response:
-            return 'error', json_response['errorMessage']
-        return 'valid', ''
+            return 'error', json_response['errorMessage'], False
+        return 'valid', '', False
     except requests.exceptions.RequestException as e:
-        return 'failed', str(e)
-
-
-def process_row(row):
-    subj_id = extract_id(row['accession_number'])
-    status, message = query_api(subj_id)
-    row['api_status'] = status
-    row['error_message'] = message
-    return row
-
-
-def process_chunk(chunk):
-    with Pool(processes=min(5, cpu_count())) as pool:
-        return pool.map(process_row, chunk)
+        return 'failed', str(e), is_transient(e)
+
+
+def retry_delay(response, attempt):
+    # Honour Retry-After (in seconds) on 429 and 503 responses, otherwise
+    # back off exponentially
+    retry_after = response.headers.get('Retry-After', '') if response is not None else ''
+    if retry_after.isdigit():
+        return int(retry_after)
+    return BACKOFF_SECONDS * 2 ** attempt
+
+
+def post_batch(subj_ids):
+    # Upper-cased IDs the archive knows, retrying connection errors, 429 and
+    # 5xx responses; raises the last error once the retries are used up
+    url = f"{ENSEMBL_SERVER}/archive/id"
+    for attempt in range(BATCH_RETRIES + 1):
+        try:
+            response = get_session().post(
+                url, json={'id': subj_ids},
+                headers={'Content-Type': 'application/json', 'Accept': 'application/json'})
+        except requests.exceptions.RequestException:
+            if attempt == BATCH_RETRIES:
+                raise
+            time.sleep(retry_delay(None, attempt))
+            continue
+        if response.status_code in RETRY_STATUSES and attempt < BATCH_RETRIES:
+            time.sleep(retry_delay(response, attempt))
+            continue
+        response.raise_for_status()
+        return {entry['id'].upper() for entry in response.json() if entry.get('id')}
 
 
-def process_csv(input_file, output_file, chunk_size=100):
-    with open(input_file, 'r') as infile, open(output_file, 'w') as outfile:
+def query_batch(subj_ids):
+    # The endpoint only returns entries for IDs it knows, so IDs missing from
+    # the response are unknown. They are reported as failed, the status
+    # per-ID mode gives for Ensembl's 400 on an unknown ID, without a request
+    # of their own. Only a batch that still fails after its retries is
+    # queried one ID at a time
+    try:
+        found = post_batch(subj_ids)
+    except requests.exceptions.RequestException as e:
+        print(f"Batch of {len(subj_ids)} IDs failed ({e}), querying them one at a time")
+        return [query_api(subj_id) for subj_id in subj_ids]
+    return [('valid', '', False) if subj_id.upper() in found
+            else ('failed', f"ID '{subj_id}' not found", False)
+            for subj_id in subj_ids]
+
+
+def query_ids(pool, subj_ids, batch_size):
+    if not batch_size:
+        return pool.map(query_api, subj_ids)
+    batches = [subj_ids[i:i + batch_size] for i in range(0, len(subj_ids), batch_size)]
+    return [result for batch_results in pool.map(query_batch, batches)
+            for result in batch_results]
+
+
+def process_chunk(pool, chunk, results, batch_size=0):
+    # Each distinct ID is queried once per chunk; `results` carries the
+    # answers across chunks and rows are filled in from it in input order.
+    # Transient failures are not kept, so a later chunk asks again
+    subj_ids = [extract_id(row['accession_number']) for row in chunk]
+    pending = list(dict.fromkeys(subj_id for subj_id in subj_ids if subj_id not in results))
+    answers = {}
+    for subj_id, (status, message, transient) in zip(pending, query_ids(pool, pending, batch_size) if pending else []):
+        answers[subj_id] = (status, message)
+        if not transient:
+            results[subj_id] = (status, message)
+    for row, subj_id in zip(chunk, subj_ids):
+        row['api_status'], row['error_message'] = results.get(subj_id) or answers[subj_id]
+    return chunk
+
+
+def process_csv(input_file, output_file, chunk_size=100, batch_size=0, workers=5):
+    if batch_size:
+        chunk_size = batch_size * workers
+    results = {}
+    with open(input_file, 'r') as infile, open(output_file, 'w') as outfile, \
+            Pool(processes=workers) as pool:
         reader = csv.DictReader(infile)
         fieldnames = reader.fieldnames + ['api_status', 'error_message']
         writer = csv.DictWriter(outfile, fieldnames=fieldnames)
@@ -59,13 +152,14 @@ def process_csv(input_file, output_file, chunk_size=100):
             chunk = list(islice(reader, chunk_size))
             if not chunk:
                 break
-            processed_chunk = process_chunk(chunk)
+            processed_chunk = process_chunk(pool, chunk, results, batch_size)
             writer.writerows(processed_chunk)
 
 
 def main():
     args = parse_arguments()
-    process_csv(args.input_file, args.output_file)
+    process_csv(args.input_file, args.output_file,
+                batch_size=args.batch_size, workers=args.workers)
     print(f"Processing complete. Output written to {args.output_file}")
 
 
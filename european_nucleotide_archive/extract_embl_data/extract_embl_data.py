@@ -1,9 +1,21 @@
 import os
+import sys
 import csv
+import asyncio
 import argparse
-import requests
+from itertools import islice
 from collections import defaultdict
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from common.checkpoint import DEFAULT_CHECKPOINT_EVERY, Checkpoint, add_checkpoint_arguments
+from common.async_enrichment import FetchError, add_engine_arguments, engine_options, enrich_rows
+
+RATE_LIMITS = {
+    'www.ebi.ac.uk': 10,
+}
+ENA_EMBL_URL = "https://www.ebi.ac.uk/ena/browser/api/embl/"
+EMBL_FIELDS = ('RX', 'RA', 'RT', 'RL', 'CC')
+
 
 def parse_arguments():
     parser = argparse.ArgumentParser(
@@ -11,66 +23,190 @@ def parse_arguments():
     parser.add_argument('-i', '--input_csv', help='Path to input CSV file')
     parser.add_argument('-o', '--output_csv',
                         help='Path to output CSV file (optional)')
+    parser.add_argument('-b', '--batch_size', type=int, default=0,
+                        help='Accessions fetched per ENA browser API request; 0 fetches one accession at a time (default: 0)')
+    add_engine_arguments(parser)
+    add_checkpoint_arguments(parser)
     return parser.parse_args()
 
 
-def fetch_embl_data(subj_id):
-    url = f"https://www.ebi.ac.uk/ena/browser/api/embl/{subj_id}?lineLimit=1000"
-    response = requests.get(url)
-    return response.status_code, response.text if response.status_code == 200 else None
+def embl_url(subj_id):
+    return f"{ENA_EMBL_URL}{subj_id}?lineLimit=1000"
 
 
-def parse_embl_data(embl_text):
+def embl_batch_url(accessions):
+    # lineLimit may cap the whole response rather than each record, so batches
+    # ask for the annotation without the sequence instead
+    return f"{ENA_EMBL_URL}{','.join(accessions)}?annotationOnly=true"
+
+
+async def fetch_embl_data(engine, subj_id):
+    response = await engine.fetch(embl_url(subj_id))
+    return response.status, response.text if response.status == 200 else None
+
+
+def parse_embl_lines(lines):
     # Extracted from EMBL Data Format - https://bibiserv.cebitec.uni-bielefeld.de/sadr/data_formats/embl_df.html
     # RX (Reference Cross-reference): optional line type which contains a cross-reference to an external citation or abstract database.
     # RA (Reference Author): lists the authors of the paper (or other work) cited.
     # RT (Reference Title): give the title of the paper (or other work).
     # RL (Reference Location): contains the conventional citation information for the reference.
     # CC: free text comments about the entry, and may be used to convey any sort of information thought to be useful.
+    # Header lines all come before the sequence, so reading stops at SQ
     data = defaultdict(list)
-    current_section = None
-    for line in embl_text.split('\n'):
-        if line.startswith('RX'):
-            data['RX'].append(line[5:].strip())
-        elif line.startswith('RA'):
-            data['RA'].append(line[5:].strip())
-        elif line.startswith('RT'):
-            data['RT'].append(line[5:].strip())
-        elif line.startswith('RL'):
-            data['RL'].append(line[5:].strip())
-        elif line.startswith('CC'):
-            data['CC'].append(line[5:].strip())
+    for line in lines:
+        code = line[:2]
+        if code == 'SQ':
+            break
+        if code in EMBL_FIELDS:
+            data[code].append(line[5:].strip())
     return {k: ' '.join(v) for k, v in data.items()}
 
 
-def process_csv(input_file, output_file):
-    with open(input_file, 'r') as infile, open(output_file, 'w', newline='') as outfile:
+def parse_embl_data(embl_text):
+    return parse_embl_lines(embl_text.split('\n'))
+
+
+def record_accessions(line):
+    # Accessions a record answers for, from its ID line (with and without
+    # the sequence version) or AC lines
+    fields = [field.strip() for field in line[5:].split(';')]
+    if line.startswith('ID'):
+        accessions = [fields[0]]
+        if len(fields) > 1 and fields[1].startswith('SV '):
+            accessions.append(f"{fields[0]}.{fields[1][3:].strip()}")
+        return accessions
+    return [field for field in fields if field]
+
+
+async def read_embl_records(lines):
+    # Splits a concatenated EMBL flat-file stream into records as it arrives.
+    # Each record's header lines are collected until its SQ line; the
+    # sequence is skipped up to the // terminator. A record cut short
+    # without // is closed by the next ID line or the end of the stream.
+    # Returns {accession: parsed fields}
+    records = {}
+    accessions, header = [], []
+    in_header = False
+
+    def finish():
+        fields = parse_embl_lines(header)
+        for accession in accessions:
+            records.setdefault(accession.upper(), fields)
+
+    async for line in lines:
+        code = line[:2]
+        if code == '//' or code == 'ID':
+            if accessions or header:
+                finish()
+            accessions, header = [], []
+            in_header = code == 'ID'
+            if code == '//':
+                continue
+        if not in_header:
+            continue
+        if code == 'SQ':
+            in_header = False
+        elif code in ('ID', 'AC'):
+            accessions.extend(record_accessions(line))
+        else:
+            header.append(line)
+    if accessions or header:
+        finish()
+    return records
+
+
+def match_record(accession, records):
+    # Records are keyed by their bare and versioned accessions, so a bare
+    # accession matches any version, while a versioned one only matches a
+    # record of that version. Anything else is fetched on its own, so that
+    # ENA decides what a different version resolves to
+    return records.get(accession.strip().upper())
+
+
+async def fetch_embl_batch(engine, accessions):
+    # One request for the whole batch. Returns {} when the batch request
+    # fails, so that every accession is then fetched on its own
+    try:
+        async with engine.stream(embl_batch_url(accessions)) as response:
+            if response.status != 200:
+                print(f"Batch of {len(accessions)} accessions failed ({response.status}), fetching them one at a time")
+                return {}
+            return await read_embl_records(response.lines)
+    except FetchError as e:
+        print(f"Batch of {len(accessions)} accessions failed ({e}), fetching them one at a time")
+        return {}
+
+
+def annotate_row(row, status_code, embl_data):
+    row['URL'] = embl_url(row['subjId'])
+    if status_code == 200:
+        row['subjId_valid'] = 'True'
+        row['error_code'] = ''
+        row.update(embl_data)
+    else:
+        row['subjId_valid'] = 'False'
+        row['error_code'] = str(status_code)
+        row.update({
+            'RX': '',
+            'RA': '',
+            'RT': '',
+            'RL': '',
+            'CC': ''
+        })
+    return row
+
+
+async def enrich_row(engine, row):
+    status_code, embl_text = await fetch_embl_data(engine, row['subjId'])
+    embl_data = parse_embl_data(embl_text) if status_code == 200 else None
+    return annotate_row(row, status_code, embl_data)
+
+
+async def enrich_batch(engine, rows):
+    accessions = list(dict.fromkeys(row['subjId'] for row in rows))
+    records = await fetch_embl_batch(engine, accessions)
+    results = {}
+    for accession in accessions:
+        embl_data = match_record(accession, records)
+        if embl_data is not None:
+            results[accession] = (200, embl_data)
+    # Accessions missing from the batch response are fetched on their own,
+    # which reports their actual status (usually 404)
+    missing = [accession for accession in accessions if accession not in results]
+    for accession, (status_code, embl_text) in zip(missing, await asyncio.gather(
+            *(fetch_embl_data(engine, accession) for accession in missing))):
+        results[accession] = (status_code, parse_embl_data(embl_text) if status_code == 200 else None)
+    return [annotate_row(row, *results[row['subjId']]) for row in rows]
+
+
+def batches(rows, batch_size):
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def process_csv(input_file, output_file, options, resume=False, checkpoint_every=DEFAULT_CHECKPOINT_EVERY,
+                batch_size=0):
+    with open(input_file, 'r') as infile, \
+            Checkpoint(output_file, input_file, resume, checkpoint_every, newline='') as checkpoint:
         reader = csv.DictReader(infile)
         fieldnames = reader.fieldnames + \
             ['URL', 'subjId_valid', 'error_code', 'RX', 'RA', 'RT', 'RL', 'CC']
-        writer = csv.DictWriter(outfile, fieldnames=fieldnames)
-        writer.writeheader()
-        for row in reader:
-            subj_id = row['subjId']
-            url = f"https://www.ebi.ac.uk/ena/browser/api/embl/{subj_id}?lineLimit=1000"
-            row['URL'] = url
-            status_code, embl_text = fetch_embl_data(subj_id)
-            if status_code == 200:
-                row['subjId_valid'] = 'True'
-                row['error_code'] = ''
-                embl_data = parse_embl_data(embl_text)
-                row.update(embl_data)
-            else:
-                row['subjId_valid'] = 'False'
-                row['error_code'] = str(status_code)
-                row.update({
-                    'RX': '',
-                    'RA': '',
-                    'RT': '',
-                    'RL': '',
-                    'CC': ''
-                })
-            writer.writerow(row)
+        writer = csv.DictWriter(checkpoint.output, fieldnames=fieldnames)
+        if checkpoint.needs_header:
+            writer.writeheader()
+        write_row = checkpoint.row_writer(writer)
+        if batch_size:
+            def write_batch(rows):
+                for row in rows:
+                    write_row(row)
+            enrich_rows(batches(checkpoint.skip(reader), batch_size), enrich_batch, write_batch, **options)
+        else:
+            enrich_rows(checkpoint.skip(reader), enrich_row, write_row, **options)
 
 
 def main():
@@ -81,7 +217,8 @@ def main():
     else:
         input_base = os.path.splitext(input_file)[0]
         output_file = f"{input_base}_w_embl_data.csv"
-    process_csv(input_file, output_file)
+    process_csv(input_file, output_file, engine_options(args, RATE_LIMITS),
+                args.resume, args.checkpoint_every, args.batch_size)
 
 
 if __name__ == '__main__':
@@ -1,22 +1,61 @@
+import os
+import re
+import sys
 import csv
+import json
+import asyncio
+import sqlite3
+import hashlib
 import argparse
-import re
-import requests
-import os
-from flair.data import Sentence
-from flair.models import SequenceTagger
+from itertools import islice
+from multiprocessing import Pool
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from common.async_enrichment import EnrichmentEngine, add_engine_arguments, engine_options
+from common.ror_resolver import add_ror_arguments, open_resolver
 
-ROR_URL = "https://api.ror.org/organizations"
 MODEL_PATH = 'flair/ner-english'
+BACKENDS = ('flair', 'quantized')
+DEFAULT_CHUNK_SIZE = 1000
+DEFAULT_NER_BATCH_SIZE = 32
+RATE_LIMITS = {
+    'api.ror.org': 5,
+}
+# Capitalized words that appear in the RL/CC boilerplate of direct
+# submissions ("Submitted (01-JAN-2020) to the INSDC.") and never name an
+# organisation on their own. Words are letters only, so that the date in
+# "01-JAN-2020" gives the word JAN rather than JAN-2020
+CAPITALIZED_WORD = re.compile(r"\b[A-Z][A-Za-z&']*")
+BOILERPLATE_WORDS = {
+    'Submitted', 'INSDC', 'Unpublished', 'JAN', 'FEB', 'MAR', 'APR', 'MAY', 'JUN',
+    'JUL', 'AUG', 'SEP', 'OCT', 'NOV', 'DEC',
+}
+
+worker_model = None
 
 
-def load_ner_model():
-    return SequenceTagger.load(MODEL_PATH)
+def load_ner_model(backend='flair', model_path=None):
+    # flair and torch are only imported once a text actually needs tagging;
+    # importing them costs seconds and a large share of the process's memory
+    if backend == 'quantized':
+        import torch
+        import flair
+        import flair.models  # noqa: F401 - classes of the pickled tagger
+        from torch.ao.nn.quantized.dynamic import LSTM
+        # Dynamically quantized layers only run on the CPU
+        flair.device = torch.device('cpu')
+        # Quantized LSTMs have no cuDNN weights to flatten, but flair's
+        # language models still ask for it before each forward pass
+        if not hasattr(LSTM, 'flatten_parameters'):
+            LSTM.flatten_parameters = lambda self: None
+        model = torch.load(model_path, map_location='cpu', weights_only=False)
+        model.eval()
+        return model
+    from flair.models import SequenceTagger
+    return SequenceTagger.load(model_path or MODEL_PATH)
 
 
-def extract_organisation_names(text, model):
-    sentence = Sentence(text)
-    model.predict(sentence)
+def organisation_names(sentence):
     names = {entity.text for entity in sentence.get_spans(
         'ner') if entity.tag == 'ORG'}
     # INSDC is the International Nucleotide Sequence Database Collaboration to which most
@@ -25,31 +64,176 @@ def extract_organisation_names(text, model):
     return list(names)
 
 
-def get_ror_id(org_name):
-    if org_name is None or not re.search(r"[a-zA-Z]", org_name):
-        return None
-    org_name = re.sub(r'[{."\\]', "", org_name)
-    matched = requests.get(ROR_URL, {"affiliation": org_name})
-    if matched.status_code != 200:
-        return None
-    matched = matched.json()
-    for matched_org in matched["items"]:
-        if matched_org["chosen"]:
-            return matched_org["organization"]["id"]
-    return None
-
-
-def process_row(row, model):
-    combined_text = row['RL'] + ' ' + row['CC']
-    org_names = extract_organisation_names(combined_text, model)
-    matched_ids = []
-    for org_name in org_names:
-        ror_id = get_ror_id(org_name)
-        if ror_id:
-            matched_ids.append(ror_id)
-    row['matched_ids'] = ';'.join(matched_ids)
-    row['extracted_orgs'] = ';'.join(org_names)
-    return row
+def extract_organisation_names_batch(texts, model, batch_size=DEFAULT_NER_BATCH_SIZE):
+    # Each distinct text is tagged once. Texts are sorted longest first so
+    # that each mini-batch holds sentences of similar length and little
+    # padding, and the names are then handed back in the order of `texts`
+    from flair.data import Sentence
+    distinct = sorted(set(texts), key=len, reverse=True)
+    names = {}
+    for start in range(0, len(distinct), batch_size):
+        batch = distinct[start:start + batch_size]
+        sentences = [Sentence(text) for text in batch]
+        model.predict(sentences, mini_batch_size=batch_size)
+        for text, sentence in zip(batch, sentences):
+            names[text] = organisation_names(sentence)
+    return [names[text] for text in texts]
+
+
+def may_contain_organisation(text):
+    # The tagger is cased, so a text without a capitalized word outside the
+    # submission boilerplate is not expected to hold an ORG span
+    return any(word not in BOILERPLATE_WORDS for word in CAPITALIZED_WORD.findall(text))
+
+
+def init_worker(workers, backend, model_path):
+    # Each worker loads its own tagger once and keeps to its share of the
+    # cores, so that the workers' torch thread pools do not compete
+    global worker_model
+    import torch
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // workers))
+    worker_model = load_ner_model(backend, model_path)
+
+
+def tag_shard(texts, batch_size):
+    return extract_organisation_names_batch(texts, worker_model, batch_size)
+
+
+class NameCache:
+    # sqlite store of the ORG names extracted from each text, keyed by a hash
+    # of the model name and the text, so that boilerplate repeated across
+    # accessions and runs is tagged once
+    def __init__(self, path, model_name=MODEL_PATH):
+        # model_name must tell apart every model whose output may be cached
+        self.model_name = model_name
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS names (key TEXT PRIMARY KEY, names TEXT)')
+
+    def key(self, text):
+        return hashlib.sha256(f"{self.model_name}\0{text}".encode('utf-8')).hexdigest()
+
+    def get_many(self, texts):
+        found = {}
+        for text in texts:
+            row = self.connection.execute(
+                'SELECT names FROM names WHERE key = ?', (self.key(text),)).fetchone()
+            if row is not None:
+                found[text] = json.loads(row[0])
+        return found
+
+    def put_many(self, names):
+        self.connection.executemany(
+            'INSERT OR REPLACE INTO names VALUES (?, ?)',
+            [(self.key(text), json.dumps(text_names)) for text, text_names in names.items()])
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+
+class OrgExtractor:
+    # ORG names for a list of texts. Each distinct text is answered from the
+    # name cache, skipped by the pre-filter, or tagged: in this process, or
+    # split across `workers` processes that each hold a model. The model (or
+    # the worker pool) is only loaded when the first text needs tagging
+    def __init__(self, backend='flair', model_path=None, workers=1,
+                 batch_size=DEFAULT_NER_BATCH_SIZE, cache=None, prefilter=False):
+        self.backend = backend
+        self.model_path = model_path
+        self.model = None
+        self.workers = workers
+        self.batch_size = batch_size
+        self.cache = cache
+        self.prefilter = prefilter
+        self.pool = None
+        self.counts = {'texts': 0, 'cached': 0, 'filtered': 0, 'tagged': 0}
+
+    def tag(self, texts):
+        if self.workers <= 1:
+            if self.model is None:
+                self.model = load_ner_model(self.backend, self.model_path)
+            return extract_organisation_names_batch(texts, self.model, self.batch_size)
+        if self.pool is None:
+            self.pool = Pool(self.workers, initializer=init_worker,
+                             initargs=(self.workers, self.backend, self.model_path))
+        # Deal the texts out longest first, so every shard gets a similar mix
+        # of lengths
+        ordered = sorted(texts, key=len, reverse=True)
+        shards = [ordered[i::self.workers] for i in range(self.workers)]
+        shards = [shard for shard in shards if shard]
+        names = {}
+        for shard, shard_names in zip(shards, self.pool.starmap(
+                tag_shard, [(shard, self.batch_size) for shard in shards])):
+            names.update(zip(shard, shard_names))
+        return [names[text] for text in texts]
+
+    def extract(self, texts):
+        distinct = list(dict.fromkeys(texts))
+        names = self.cache.get_many(distinct) if self.cache is not None else {}
+        pending = [text for text in distinct if text not in names]
+        self.counts['texts'] += len(distinct)
+        self.counts['cached'] += len(names)
+        if self.prefilter:
+            skipped = [text for text in pending if not may_contain_organisation(text)]
+            names.update((text, []) for text in skipped)
+            pending = [text for text in pending if text not in names]
+            self.counts['filtered'] += len(skipped)
+        if pending:
+            tagged = dict(zip(pending, self.tag(pending)))
+            self.counts['tagged'] += len(pending)
+            if self.cache is not None:
+                self.cache.put_many(tagged)
+            names.update(tagged)
+        return [names[text] for text in texts]
+
+    def summary(self):
+        return (f"NER: {self.counts['texts']} distinct texts, {self.counts['cached']} from cache, "
+                f"{self.counts['filtered']} skipped by the pre-filter, {self.counts['tagged']} tagged")
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+        if self.cache is not None:
+            self.cache.close()
+
+
+def needs_matching(row):
+    return row['subjId_valid'] == "True" and bool(row['RL'] or row['CC'])
+
+
+async def process_chunk(engine, resolver, rows, extractor):
+    # Extract the organisations of every row in the chunk first, then resolve
+    # the chunk's distinct names in one concurrent pass
+    matched = [row for row in rows if needs_matching(row)]
+    extracted = iter(extractor.extract([row['RL'] + ' ' + row['CC'] for row in matched]))
+    org_names = [next(extracted) if needs_matching(row) else [] for row in rows]
+    ror_ids = await resolver.resolve_all(
+        engine, [name for names in org_names for name in names])
+    for row, names in zip(rows, org_names):
+        row['matched_ids'] = ';'.join(ror_ids[name] for name in names if ror_ids[name])
+        row['extracted_orgs'] = ';'.join(names)
+    return rows
+
+
+def process_csv(input_file, output_file, extractor, options, resolver, chunk_size=DEFAULT_CHUNK_SIZE):
+    async def run():
+        async with EnrichmentEngine(**options) as engine:
+            with open(input_file, 'r') as f_in, open(output_file, 'w') as f_out:
+                reader = csv.DictReader(f_in)
+                fieldnames = reader.fieldnames + ['matched_ids', 'extracted_orgs']
+                writer = csv.DictWriter(f_out, fieldnames=fieldnames)
+                writer.writeheader()
+                while True:
+                    rows = list(islice(reader, chunk_size))
+                    if not rows:
+                        break
+                    writer.writerows(await process_chunk(engine, resolver, rows, extractor))
+    asyncio.run(run())
+    print(extractor.summary())
+    print(resolver.summary())
 
 
 def parse_arguments():
@@ -59,12 +243,36 @@ def parse_arguments():
                       help="Path to the input CSV file")
     args.add_argument("-o", "--output_file",
                       help="Path to the output CSV file")
-    return args.parse_args()
+    args.add_argument("-c", "--chunk_size", type=int, default=DEFAULT_CHUNK_SIZE,
+                      help=f"Rows whose organisation names are resolved together (default: {DEFAULT_CHUNK_SIZE})")
+    args.add_argument("-n", "--ner_batch_size", type=int, default=DEFAULT_NER_BATCH_SIZE,
+                      help=f"Distinct texts tagged per NER model call (default: {DEFAULT_NER_BATCH_SIZE})")
+    args.add_argument("-w", "--workers", type=int, default=1,
+                      help="Processes tagging texts, each with its own copy of the model (default: 1)")
+    args.add_argument("-b", "--backend", choices=BACKENDS, default='flair',
+                      help="flair loads the tagger with SequenceTagger.load; quantized loads a tagger "
+                           "exported by utils/export_quantized_model.py from --model_path (default: flair)")
+    args.add_argument("-m", "--model_path",
+                      help=f"Model name or file for the flair backend (default: {MODEL_PATH}), "
+                           "or the exported file for the quantized backend")
+    args.add_argument("--ner_cache",
+                      help="sqlite file caching the organisation names extracted from each text between runs")
+    args.add_argument("--prefilter", action="store_true",
+                      help="Skip the model for texts without a capitalized word outside the submission boilerplate")
+    add_engine_arguments(args)
+    add_ror_arguments(args)
+    parsed = args.parse_args()
+    if parsed.backend == 'quantized' and not parsed.model_path:
+        args.error('--backend quantized requires --model_path')
+    return parsed
 
 
 def main():
     args = parse_arguments()
-    model = load_ner_model()
+    model_path = args.model_path or MODEL_PATH
+    cache = NameCache(args.ner_cache, f"{args.backend}:{model_path}") if args.ner_cache else None
+    extractor = OrgExtractor(args.backend, model_path, args.workers,
+                             args.ner_batch_size, cache, args.prefilter)
 
     if args.output_file:
         output_file = args.output_file
@@ -72,24 +280,11 @@ def main():
         input_base = os.path.splitext(args.input_file)[0]
         output_file = f"{input_base}_extracted_org_names_matched_ror.csv"
 
-    with open(args.input_file, 'r') as f_in, open(output_file, 'w') as f_out:
-        reader = csv.DictReader(f_in)
-        fieldnames = reader.fieldnames + ['matched_ids', 'extracted_orgs']
-        writer = csv.DictWriter(f_out, fieldnames=fieldnames)
-        writer.writeheader()
-        for row in reader:
-            if row['subjId_valid'] == "True":
-                if row['RL'] or row['CC']:
-                    processed_row = process_row(row, model)
-                    writer.writerow(processed_row)
-                else:
-                    row['matched_ids'] = ''
-                    row['extracted_orgs'] = ''
-                    writer.writerow(row)
-            else:
-                row['matched_ids'] = ''
-                row['extracted_orgs'] = ''
-                writer.writerow(row)
+    try:
+        process_csv(args.input_file, output_file, extractor,
+                    engine_options(args, RATE_LIMITS), open_resolver(args), args.chunk_size)
+    finally:
+        extractor.close()
     print(f"Processing complete. Output written to {output_file}")
 
 
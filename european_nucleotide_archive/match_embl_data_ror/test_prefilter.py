@@ -0,0 +1,20 @@
+import unittest
+
+from match_embl_data_ror import may_contain_organisation
+
+
+class PrefilterTest(unittest.TestCase):
+    def test_submission_boilerplate_is_skipped(self):
+        for text in ['Submitted (01-JAN-2020) to the INSDC.',
+                     'Submitted (15-DEC-1999) to the INSDC. ',
+                     'Submitted (02-FEB-2021) to the INSDC. lower case only']:
+            self.assertFalse(may_contain_organisation(text), text)
+
+    def test_capitalized_words_are_tagged(self):
+        for text in ['Submitted (02-FEB-2021) to the INSDC. University of Oxford',
+                     ' Dept. of Biology, MIT']:
+            self.assertTrue(may_contain_organisation(text), text)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+import io
+import os
+import sys
+import csv
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from match_embl_data_ror import (MODEL_PATH, DEFAULT_NER_BATCH_SIZE, load_ner_model,
+                                 extract_organisation_names_batch, needs_matching)
+
+DEFAULT_SAMPLE_SIZE = 1000
+DEFAULT_TOLERANCE = 0.98
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Export a dynamically quantized copy of the NER tagger for match_embl_data_ror.py --backend quantized, "
+                    "and check that it extracts the same organization names as the original")
+    parser.add_argument("-m", "--model_path", default=MODEL_PATH,
+                        help=f"Flair model name or file to quantize (default: {MODEL_PATH})")
+    parser.add_argument("-o", "--output", required=True,
+                        help="File the quantized tagger is written to")
+    parser.add_argument("-i", "--input_file",
+                        help="CSV written by extract_embl_data.py whose RL and CC texts are used for the parity check "
+                             "(the check is skipped when not given)")
+    parser.add_argument("-s", "--sample_size", type=int, default=DEFAULT_SAMPLE_SIZE,
+                        help=f"Distinct texts compared in the parity check (default: {DEFAULT_SAMPLE_SIZE})")
+    parser.add_argument("-t", "--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help=f"Lowest share of texts with identical organization names that passes "
+                             f"(default: {DEFAULT_TOLERANCE})")
+    parser.add_argument("-n", "--ner_batch_size", type=int, default=DEFAULT_NER_BATCH_SIZE,
+                        help=f"Distinct texts tagged per NER model call (default: {DEFAULT_NER_BATCH_SIZE})")
+    return parser.parse_args()
+
+
+def quantize(model):
+    # int8 weights for the linear and LSTM layers, which hold nearly all of
+    # the tagger's and its flair embeddings' parameters; activations stay in
+    # float and are quantized on the fly
+    import torch
+    return torch.quantization.quantize_dynamic(
+        model, {torch.nn.Linear, torch.nn.LSTM}, dtype=torch.qint8)
+
+
+def serialized_size(model):
+    import torch
+    buffer = io.BytesIO()
+    torch.save(model, buffer)
+    return buffer.tell()
+
+
+def sample_texts(input_file, sample_size):
+    with open(input_file, 'r', encoding='utf-8') as f:
+        texts = list(dict.fromkeys(
+            row['RL'] + ' ' + row['CC'] for row in csv.DictReader(f) if needs_matching(row)))
+    if len(texts) > sample_size:
+        texts = random.Random(0).sample(texts, sample_size)
+    return texts
+
+
+def timed_names(texts, model, batch_size):
+    start = time.perf_counter()
+    names = extract_organisation_names_batch(texts, model, batch_size)
+    return names, (time.perf_counter() - start) / max(len(texts), 1)
+
+
+def check_parity(texts, original, quantized, batch_size, tolerance):
+    original_names, original_latency = timed_names(texts, original, batch_size)
+    quantized_names, quantized_latency = timed_names(texts, quantized, batch_size)
+    differing = [(text, a, b) for text, a, b in zip(texts, original_names, quantized_names)
+                 if set(a) != set(b)]
+    agreement = 1 - len(differing) / max(len(texts), 1)
+    for text, a, b in differing[:10]:
+        print(f"Differs: {text[:100]!r}\n  flair:     {sorted(a)}\n  quantized: {sorted(b)}")
+    print(f"Per-text latency: flair {original_latency * 1000:.1f} ms, quantized {quantized_latency * 1000:.1f} ms")
+    print(f"Agreement: {len(texts) - len(differing)}/{len(texts)} texts ({agreement:.2%}), tolerance {tolerance:.2%}")
+    return agreement >= tolerance
+
+
+def main():
+    args = parse_args()
+    original = load_ner_model('flair', args.model_path)
+    quantized = quantize(original)
+    import torch
+    torch.save(quantized, args.output)
+    print(f"Model size: flair {serialized_size(original) / 2**20:.0f} MiB, "
+          f"quantized {os.path.getsize(args.output) / 2**20:.0f} MiB")
+    print(f"Quantized tagger written to {args.output}")
+    if not args.input_file:
+        return
+    # The check reloads the written file, as match_embl_data_ror.py would
+    reloaded = load_ner_model('quantized', args.output)
+    texts = sample_texts(args.input_file, args.sample_size)
+    if not check_parity(texts, original, reloaded, args.ner_batch_size, args.tolerance):
+        print("Parity check failed: the quantized tagger is below the tolerance")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,22 @@
 import os
-import re
+import sys
 import csv
 import argparse
-import requests
 from datetime import datetime
-from time import sleep
+from contextlib import nullcontext
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from common.async_enrichment import add_engine_arguments, engine_options, enrich_rows
+from common.checkpoint import DEFAULT_CHECKPOINT_EVERY, Checkpoint, add_checkpoint_arguments, saved_state
+from common.raw_archive import RawArchive
+from common.ror_resolver import add_ror_arguments, open_resolver
+
+# NCBI allows 3 requests per second without an API key
+RATE_LIMITS = {
+    'www.ncbi.nlm.nih.gov': 3,
+    'api.ror.org': 5,
+}
+CONTACT_FIELDS = ('contact_name', 'contact_institute', 'contact_country')
 
 
 def parse_args():
@@ -15,9 +27,12 @@ def parse_args():
     parser.add_argument("-o", "--output_file",
                         help="Path to the output CSV file")
     parser.add_argument("-d", "--output_dir",
-                        help="Directory to save output files")
+                        help="Directory to save the raw GEO response archive in")
     parser.add_argument("-f", "--file_download", action="store_true",
-                        help="Download raw GEO data files")
+                        help="Archive the raw GEO responses")
+    add_engine_arguments(parser)
+    add_ror_arguments(parser)
+    add_checkpoint_arguments(parser)
     return parser.parse_args()
 
 
@@ -25,84 +40,107 @@ def create_output_directories(base_dir=None):
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     if not base_dir:
         base_dir = os.path.join(os.getcwd(), f"geo_output_{timestamp}")
-    raw_dir = os.path.join(base_dir, f"raw_{timestamp}")
-    os.makedirs(raw_dir, exist_ok=True)
-    return base_dir, raw_dir, timestamp
-
-
-def fetch_geo_data(subj_id):
-    url = f"https://www.ncbi.nlm.nih.gov/geo/query/acc.cgi?acc={subj_id}&targ=self&view=brief&form=text"
-    response = requests.get(url)
-    return response.text, response.status_code, url
-
-
-def get_ror_id(org_name):
-    if org_name is None or not re.search(r"[a-zA-Z]", org_name):
-        return None
-    org_name = re.sub(r'[{."\\]', "", org_name)
-    ror_api_url = "https://api.ror.org/organizations"
-    matched = requests.get(ror_api_url, {"affiliation": org_name})
-    if matched.status_code != 200:
-        return None
-    matched = matched.json()
-    for matched_org in matched["items"]:
-        if matched_org["chosen"]:
-            return matched_org["organization"]["id"]
-    return None
-
-
-def parse_geo_data(data):
-    contact_name = ""
-    contact_institute = ""
-    contact_country = ""
+    os.makedirs(base_dir, exist_ok=True)
+    raw_archive = os.path.join(base_dir, f"raw_{timestamp}.gz")
+    return base_dir, raw_archive, timestamp
+
+
+def geo_url(subj_id):
+    return f"https://www.ncbi.nlm.nih.gov/geo/query/acc.cgi?acc={subj_id}&targ=self&view=brief&form=text"
+
+
+def read_contact_line(contact, line):
+    # Keeps the first value of each contact field, matched on the key before
+    # the "=" only, so that reading can stop early; returns True once all of
+    # them have been seen
+    key, separator, value = line.partition('=')
+    if separator:
+        key = key.lower()
+        for field in CONTACT_FIELDS:
+            if field in key:
+                contact.setdefault(field, value.strip())
+                break
+    return len(contact) == len(CONTACT_FIELDS)
+
+
+def contact_details(contact):
+    name_parts = contact.get('contact_name', '').split(',')
+    contact_name = ' '.join(part.strip() for part in name_parts if part.strip())
+    contact_institute = contact.get('contact_institute', '')
+    contact_country = contact.get('contact_country', '')
     affiliation = ""
-    for line in data.split('\n'):
-        if "contact_name" in line.lower():
-            name_parts = line.split('=', 1)[1].strip().split(',')
-            contact_name = ' '.join(part.strip()
-                                    for part in name_parts if part.strip())
-        elif "contact_institute" in line.lower():
-            contact_institute = line.split('=', 1)[1].strip()
-        elif "contact_country" in line.lower():
-            contact_country = line.split('=', 1)[1].strip()
     if contact_institute and contact_country:
         affiliation = f"{contact_institute}, {contact_country}"
     elif contact_institute:
         affiliation = contact_institute
-    ror_id = get_ror_id(affiliation)
     return {
         "contact_name": contact_name,
         "contact_institute": contact_institute,
         "contact_country": contact_country,
         "affiliation": affiliation,
-        "ror_id": ror_id
     }
 
 
-def process_csv(input_file, raw_dir, output_csv, download_files):
-    with open(input_file, 'r', encoding='utf-8') as f_in, open(output_csv, 'w', newline='', encoding='utf-8') as f_out:
+def parse_geo_data(lines):
+    contact = {}
+    for line in lines:
+        if read_contact_line(contact, line):
+            break
+    return contact_details(contact)
+
+
+async def parse_geo_stream(lines):
+    # Stops reading the response once all contact fields have been found
+    contact = {}
+    async for line in lines:
+        if read_contact_line(contact, line):
+            break
+    return contact_details(contact)
+
+
+async def enrich_row(engine, resolver, row, archive):
+    subj_id = row['subjId']
+    url = geo_url(subj_id)
+    if archive is not None:
+        response = await engine.fetch(url)
+        status_code = response.status
+        if status_code == 200:
+            archive.add(subj_id, response.text)
+            parsed_data = parse_geo_data(response.text.split('\n'))
+    else:
+        async with engine.stream(url) as response:
+            status_code = response.status
+            if status_code == 200:
+                parsed_data = await parse_geo_stream(response.lines)
+    row['url'] = url
+    row['response_code'] = status_code
+    row['success'] = status_code == 200
+    if status_code == 200:
+        parsed_data['ror_id'] = await resolver.resolve(engine, parsed_data['affiliation'])
+        row.update(parsed_data)
+    else:
+        row.update({k: '' for k in [
+                   'contact_name', 'contact_institute', 'contact_country', 'affiliation', 'ror_id']})
+    return row
+
+
+def process_csv(input_file, raw_archive, output_csv, options, resolver,
+                resume=False, checkpoint_every=DEFAULT_CHECKPOINT_EVERY):
+    with open(input_file, 'r', encoding='utf-8') as f_in, \
+            Checkpoint(output_csv, input_file, resume, checkpoint_every,
+                       state={'raw_archive': os.path.abspath(raw_archive)} if raw_archive else None,
+                       newline='', encoding='utf-8') as checkpoint, \
+            (RawArchive(raw_archive) if raw_archive else nullcontext()) as archive:
         reader = csv.DictReader(f_in)
         fieldnames = reader.fieldnames + ['url', 'response_code', 'success',
                                           'contact_name', 'contact_institute', 'contact_country', 'affiliation', 'ror_id']
-        writer = csv.DictWriter(f_out, fieldnames=fieldnames)
-        writer.writeheader()
-        for row in reader:
-            subj_id = row['subjId']
-            geo_data, status_code, url = fetch_geo_data(subj_id)
-            row['url'] = url
-            row['response_code'] = status_code
-            row['success'] = status_code == 200
-            if status_code == 200:
-                if download_files:
-                    with open(os.path.join(raw_dir, f"{subj_id}_raw.txt"), 'w', encoding='utf-8') as f:
-                        f.write(geo_data)
-                parsed_data = parse_geo_data(geo_data)
-                row.update(parsed_data)
-            else:
-                row.update({k: '' for k in [
-                           'contact_name', 'contact_institute', 'contact_country', 'affiliation', 'ror_id']})
-            writer.writerow(row)
-            sleep(2)
+        writer = csv.DictWriter(checkpoint.output, fieldnames=fieldnames)
+        if checkpoint.needs_header:
+            writer.writeheader()
+        enrich_rows(checkpoint.skip(reader),
+                    lambda engine, row: enrich_row(engine, resolver, row, archive),
+                    checkpoint.row_writer(writer), **options)
+        print(resolver.summary())
 
 
 def main():
@@ -113,12 +151,21 @@ def main():
         input_file_base = os.path.splitext(args.input_file)[0]
         output_file = f"{input_file_base}_w_GEO_data.csv"
     if args.file_download:
-        base_dir, raw_dir, timestamp = create_output_directories(
-            args.output_dir)
-        print(f"Raw files saved in {raw_dir}")
-        process_csv(args.input_file, raw_dir, output_file, args.file_download)
+        # A resumed run keeps appending to the archive of the run it resumes
+        raw_archive = saved_state(output_file).get('raw_archive') if args.resume else None
+        if raw_archive:
+            os.makedirs(os.path.dirname(raw_archive), exist_ok=True)
+        else:
+            base_dir, raw_archive, timestamp = create_output_directories(
+                args.output_dir)
+        print(f"Raw responses archived in {raw_archive}")
+        process_csv(args.input_file, raw_archive, output_file,
+                    engine_options(args, RATE_LIMITS), open_resolver(args),
+                    args.resume, args.checkpoint_every)
     else:
-        process_csv(args.input_file, None, output_file, False)
+        process_csv(args.input_file, None, output_file,
+                    engine_options(args, RATE_LIMITS), open_resolver(args),
+                    args.resume, args.checkpoint_every)
     print(f"Processing complete.")
     print(f"Processed CSV saved as {output_file}")
 
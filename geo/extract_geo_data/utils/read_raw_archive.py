@@ -0,0 +1,52 @@
+import os
+import sys
+import csv
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.raw_archive import RawArchive
+from extract_geo_data import parse_geo_data
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Read a raw GEO response archive written by extract_geo_data.py -f")
+    parser.add_argument("-a", "--archive", required=True,
+                        help="Archive file (raw_<timestamp>.gz, next to its .idx index)")
+    parser.add_argument("-l", "--list", action="store_true",
+                        help="List the archived accessions")
+    parser.add_argument("-s", "--show", action="append", default=[],
+                        help="Print the raw response for an accession. Can be repeated")
+    parser.add_argument("-p", "--parse",
+                        help="Re-parse every archived response and write the contact fields to this CSV file")
+    return parser.parse_args()
+
+
+def reparse(archive, output_file):
+    fieldnames = ['subjId', 'contact_name', 'contact_institute', 'contact_country', 'affiliation']
+    with open(output_file, 'w', newline='', encoding='utf-8') as f_out:
+        writer = csv.DictWriter(f_out, fieldnames=fieldnames)
+        writer.writeheader()
+        for subj_id, text in archive:
+            writer.writerow({'subjId': subj_id, **parse_geo_data(text.split('\n'))})
+    print(f"Re-parsed {len(archive)} responses into {output_file}")
+
+
+def main():
+    args = parse_args()
+    with RawArchive(args.archive, mode='r') as archive:
+        if args.list:
+            for subj_id, _ in sorted(archive.index.items(), key=lambda item: item[1][0]):
+                print(subj_id)
+        for subj_id in args.show:
+            if subj_id not in archive:
+                print(f"{subj_id} is not in {args.archive}")
+                continue
+            print(archive.get(subj_id))
+        if args.parse:
+            reparse(archive, args.parse)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,19 @@
 import os
+import sys
 import csv
 import argparse
 from time import sleep
+from itertools import islice
 from Bio import Entrez, SeqIO
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from common.checkpoint import DEFAULT_CHECKPOINT_EVERY, Checkpoint, add_checkpoint_arguments
+
+NCBI_BASE_URL = "https://www.ncbi.nlm.nih.gov/nuccore/"
+EFETCH_CHUNK_SIZE = 100
+FEATURE_QUALIFIER_INDENT = 21
+FEATURE_END_MARKERS = ('ORIGIN', 'CONTIG', 'BASE COUNT', '//')
+
 
 def parse_arguments():
     parser = argparse.ArgumentParser(
@@ -13,55 +23,242 @@ def parse_arguments():
     parser.add_argument('-e', '--email', required=True,
                         help="Email address for Entrez API")
     parser.add_argument('-o', '--output_file', help='Output CSV file')
+    parser.add_argument('-b', '--batch_size', type=int, default=0,
+                        help='Accessions posted to the Entrez history server per batch; 0 fetches one accession at a time (default: 0)')
+    parser.add_argument('-k', '--api_key',
+                        help='NCBI API key, raising the Entrez rate limit from 3 to 10 requests per second')
+    parser.add_argument('-p', '--parser', choices=['header', 'full'], default='full',
+                        help='full parses the whole record with SeqIO; header reads each GenBank record only up to its '
+                             'first source feature, see the README for how its results can differ (default: full)')
+    add_checkpoint_arguments(parser)
     return parser.parse_args()
 
 
-def query_ncbi(accession_number):
+def get_lab_host(record):
+    lab_host = ''
+    for feature in record.features:
+        if feature.type == "source":
+            lab_host = feature.qualifiers.get('lab_host', [''])[0]
+    return lab_host
+
+
+def read_header(lines, locus_line):
+    # Collects the LOCUS name, ACCESSION and VERSION of a record; returns the
+    # keys and the line that ended the header
+    tokens = locus_line.split()
+    keys = set(tokens[1:2])
+    keyword = 'LOCUS'
+    for line in lines:
+        if line.startswith('FEATURES') or line.startswith(FEATURE_END_MARKERS):
+            return keys, line
+        if line[:12].strip():
+            keyword = line[:12].strip()
+            if keyword == 'VERSION':
+                version = line[12:].split()[:1]
+                keys.update(version + [v.split('.')[0] for v in version])
+        if keyword == 'ACCESSION':
+            keys.update(line[12:].replace(';', ' ').split())
+    return keys, '//'
+
+
+def qualifier_value(parts):
+    # Joins and unquotes a qualifier value the way Bio.GenBank does
+    if parts is None:
+        return ''
+    value = ' '.join(parts)
+    if len(value) > 1 and value[0] == '"' and value[-1] == '"':
+        value = value[1:-1]
+    return value.replace('""', '"')
+
+
+def read_lab_host(lines):
+    # Reads the feature table up to the end of the first source feature;
+    # returns its lab_host and the line that ended it
+    in_source = False
+    open_quote = False
+    qualifiers = []
+    line = '//'
+    for line in lines:
+        if line.startswith(FEATURE_END_MARKERS):
+            break
+        if line[2:FEATURE_QUALIFIER_INDENT].strip():
+            if in_source:
+                break
+            in_source = line[2:FEATURE_QUALIFIER_INDENT].strip() == 'source'
+            continue
+        text = line[FEATURE_QUALIFIER_INDENT:].strip()
+        if not in_source or not text:
+            continue
+        if open_quote:
+            qualifiers[-1][1].append(text)
+            open_quote = not text.endswith('"')
+        elif text.startswith('/'):
+            key, has_value, value = text[1:].partition('=')
+            if value.startswith(' ') and value.lstrip().startswith('"'):
+                value = value.lstrip()
+            qualifiers.append((key, [value] if has_value else None))
+            open_quote = len(value) > 1 and value[0] == '"' and value[-1] != '"'
+        elif qualifiers and qualifiers[-1][1] is not None:
+            qualifiers[-1][1].append(text)
+    else:
+        line = '//'
+    for key, parts in qualifiers:
+        if key == 'lab_host':
+            return qualifier_value(parts), line
+    return '', line
+
+
+def scan_genbank(handle):
+    # Header-only reader: yields (record keys, lab_host) for each GenBank
+    # record once its source feature has been read. The rest of the record,
+    # sequence included, is skipped line by line without being parsed, and
+    # nothing more is read from the handle until the next record is asked for
+    lines = (line.rstrip() for line in handle)
+    for line in lines:
+        if not line.startswith('LOCUS'):
+            continue
+        keys, line = read_header(lines, line)
+        lab_host = ''
+        if line.startswith('FEATURES'):
+            lab_host, line = read_lab_host(lines)
+        yield {key.upper() for key in keys if key}, lab_host
+        while line != '//':
+            line = next(lines, '//')
+
+
+def parse_records(handle, parser='full'):
+    if parser == 'full':
+        for record in SeqIO.parse(handle, "genbank"):
+            yield record_keys(record), get_lab_host(record)
+    else:
+        yield from scan_genbank(handle)
+
+
+def query_ncbi(accession_number, parser='full'):
     try:
         handle = Entrez.efetch(
             db="nuccore", id=accession_number, rettype="gb", retmode="text")
-        record = SeqIO.read(handle, "genbank")
+        if parser == 'full':
+            lab_host = get_lab_host(SeqIO.read(handle, "genbank"))
+        else:
+            record = next(scan_genbank(handle), None)
+            if record is None:
+                raise ValueError("No records found in handle")
+            lab_host = record[1]
+        # In header mode this drops the connection before the sequence arrives
         handle.close()
-        lab_host = ''
-        for feature in record.features:
-            if feature.type == "source":
-                lab_host = feature.qualifiers.get('lab_host', [''])[0]
-        ncbi_base_url = "https://www.ncbi.nlm.nih.gov/nuccore/"
-        ncbi_url = f"{ncbi_base_url}{accession_number}"
+        ncbi_url = f"{NCBI_BASE_URL}{accession_number}"
         return True, ncbi_url, lab_host
     except Exception as e:
         print(e)
         return False, None, None
 
 
-def process_and_write(input_file, output_file):
-    with open(input_file, 'r') as infile, open(output_file, 'w', newline='') as outfile:
+def record_keys(record):
+    # A record answers for its accession.version, bare accession, LOCUS name
+    # and any secondary accessions
+    keys = {record.id, record.id.split('.')[0], record.name}
+    keys.update(record.annotations.get('accessions', []))
+    return {key.upper() for key in keys if key}
+
+
+def match_accession(accession_number, lab_hosts):
+    accession = accession_number.strip().upper()
+    if accession in lab_hosts:
+        return lab_hosts[accession]
+    return lab_hosts.get(accession.split('.')[0])
+
+
+def fetch_batch(accession_numbers, parser='full'):
+    # Post the batch to the history server once, then page through the
+    # GenBank records in EFETCH_CHUNK_SIZE chunks
+    handle = Entrez.epost(db="nuccore", id=",".join(accession_numbers))
+    posted = Entrez.read(handle)
+    handle.close()
+    lab_hosts = {}
+    for start in range(0, len(accession_numbers), EFETCH_CHUNK_SIZE):
+        handle = Entrez.efetch(db="nuccore", rettype="gb", retmode="text",
+                               webenv=posted["WebEnv"], query_key=posted["QueryKey"],
+                               retstart=start, retmax=EFETCH_CHUNK_SIZE)
+        for keys, lab_host in parse_records(handle, parser):
+            for key in keys:
+                lab_hosts[key] = lab_host
+        handle.close()
+    return lab_hosts
+
+
+def query_ncbi_batch(accession_numbers, parser='full'):
+    # Falls back to one efetch per accession when the batch request fails,
+    # e.g. when epost rejects an invalid accession
+    try:
+        lab_hosts = fetch_batch(accession_numbers, parser)
+    except Exception as e:
+        print(f"Batch of {len(accession_numbers)} accessions failed ({e}), querying them one at a time")
+        return {accession_number: query_ncbi(accession_number, parser)
+                for accession_number in accession_numbers}
+    results = {}
+    for accession_number in accession_numbers:
+        lab_host = match_accession(accession_number, lab_hosts)
+        if lab_host is None:
+            print(f"No record returned for {accession_number}")
+            results[accession_number] = (False, None, None)
+        else:
+            results[accession_number] = (True, f"{NCBI_BASE_URL}{accession_number}", lab_host)
+    return results
+
+
+def annotate_row(row, result):
+    valid, ncbi_url, lab_host = result
+    row.update({
+        'Valid': valid,
+        'NCBI_URL': ncbi_url,
+        'Lab_Host': lab_host
+    })
+    return row
+
+
+def process_and_write(input_file, output_file, resume=False,
+                      checkpoint_every=DEFAULT_CHECKPOINT_EVERY, batch_size=0,
+                      parser='full'):
+    with open(input_file, 'r') as infile, \
+            Checkpoint(output_file, input_file, resume, checkpoint_every, newline='') as checkpoint:
         reader = csv.DictReader(infile)
         fieldnames = reader.fieldnames + ['Valid', 'NCBI_URL', 'Lab_Host']
-        writer = csv.DictWriter(outfile, fieldnames=fieldnames)
-        writer.writeheader()
-        for row in reader:
-            accession_number = row['accessionNumber']
-            valid, ncbi_url, lab_host = query_ncbi(accession_number)
-            row.update({
-                'Valid': valid,
-                'NCBI_URL': ncbi_url,
-                'Lab_Host': lab_host
-            })
-            writer.writerow(row)
-            sleep(1)
+        writer = csv.DictWriter(checkpoint.output, fieldnames=fieldnames)
+        if checkpoint.needs_header:
+            writer.writeheader()
+        rows = checkpoint.skip(reader)
+        if batch_size:
+            while True:
+                chunk = list(islice(rows, batch_size))
+                if not chunk:
+                    break
+                accession_numbers = list(dict.fromkeys(row['accessionNumber'] for row in chunk))
+                results = query_ncbi_batch(accession_numbers, parser)
+                for row in chunk:
+                    writer.writerow(annotate_row(row, results[row['accessionNumber']]))
+                    checkpoint.record()
+        else:
+            for row in rows:
+                accession_number = row['accessionNumber']
+                writer.writerow(annotate_row(row, query_ncbi(accession_number, parser)))
+                checkpoint.record()
+                sleep(1)
     print(f"Processing complete. Results written to {output_file}")
 
 
 def main():
     args = parse_arguments()
     Entrez.email = args.email
+    if args.api_key:
+        Entrez.api_key = args.api_key
     if args.output_file:
         output_file = args.output_file
     else:
         input_file_base = os.path.splitext(args.input_file)[0]
         output_file = f"{input_file_base}_w_ncbi_data.csv"
-    process_and_write(args.input_file, output_file)
+    process_and_write(args.input_file, output_file,
+                      args.resume, args.checkpoint_every, args.batch_size, args.parser)
 
 
 if __name__ == "__main__":
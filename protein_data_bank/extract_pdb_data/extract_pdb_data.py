@@ -1,12 +1,20 @@
 import io
 import os
 import re
+import sys
 import csv
 import gzip
 import argparse
-import requests
 from collections import defaultdict
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from common.checkpoint import DEFAULT_CHECKPOINT_EVERY, Checkpoint, add_checkpoint_arguments
+from common.async_enrichment import add_engine_arguments, engine_options, enrich_rows
+
+RATE_LIMITS = {
+    'files.wwpdb.org': 10,
+}
+
 
 def parse_args():
     parser = argparse.ArgumentParser(
@@ -14,14 +22,16 @@ def parse_args():
     parser.add_argument('-i', '--input_file',
                         required=True, help='Input CSV file')
     parser.add_argument('-o', '--output_file', help='Output CSV file')
+    add_engine_arguments(parser)
+    add_checkpoint_arguments(parser)
     return parser.parse_args()
 
 
-def fetch_pdb_file(subj_id):
+async def fetch_pdb_file(engine, subj_id):
     url = f"https://files.wwpdb.org/pub/pdb/data/structures/all/pdb/pdb{subj_id.lower()}.ent.gz"
-    response = requests.get(url)
-    if response.status_code == 200:
-        print(response.status_code)
+    response = await engine.fetch(url)
+    if response.status == 200:
+        print(response.status)
         return response.content
     else:
         return None
@@ -67,23 +77,28 @@ def find_common_authors(author_str, jrnl_auth_str):
     return ','.join(author_set.intersection(jrnl_auth_set))
 
 
-def process_csv(input_file, output_file):
-    with open(input_file, 'r') as infile, open(output_file, 'w', newline='') as outfile:
+async def enrich_row(engine, row):
+    subj_id = row['subjId']
+    pdb_content = await fetch_pdb_file(engine, subj_id)
+    if pdb_content:
+        pdb_data = parse_pdb_content(pdb_content)
+        print(pdb_data)
+        row.update(pdb_data)
+        row['COMMON_AUTHORS'] = find_common_authors(
+            pdb_data.get('AUTHOR', ''), pdb_data.get('JRNL_AUTH', ''))
+    return row
+
+
+def process_csv(input_file, output_file, options, resume=False, checkpoint_every=DEFAULT_CHECKPOINT_EVERY):
+    with open(input_file, 'r') as infile, \
+            Checkpoint(output_file, input_file, resume, checkpoint_every, newline='') as checkpoint:
         reader = csv.DictReader(infile)
         fieldnames = reader.fieldnames + ['TITLE', 'KEYWDS', 'AUTHOR', 'JRNL_AUTH',
                                           'JRNL_TITL', 'JRNL_REF', 'JRNL_PMID', 'JRNL_DOI', 'COMMON_AUTHORS']
-        writer = csv.DictWriter(outfile, fieldnames=fieldnames)
-        writer.writeheader()
-        for row in reader:
-            subj_id = row['subjId']
-            pdb_content = fetch_pdb_file(subj_id)
-            if pdb_content:
-                pdb_data = parse_pdb_content(pdb_content)
-                print(pdb_data)
-                row.update(pdb_data)
-                row['COMMON_AUTHORS'] = find_common_authors(
-                    pdb_data.get('AUTHOR', ''), pdb_data.get('JRNL_AUTH', ''))
-            writer.writerow(row)
+        writer = csv.DictWriter(checkpoint.output, fieldnames=fieldnames)
+        if checkpoint.needs_header:
+            writer.writeheader()
+        enrich_rows(checkpoint.skip(reader), enrich_row, checkpoint.row_writer(writer), **options)
 
 
 def main():
@@ -93,7 +108,8 @@ def main():
     else:
         input_file_base = os.path.splitext(args.input_file)[0]
         output_file = f"{input_file_base}_w_pdb_metadata.csv"
-    process_csv(args.input_file, output_file)
+    process_csv(args.input_file, output_file, engine_options(args, RATE_LIMITS),
+                args.resume, args.checkpoint_every)
 
 
 if __name__ == "__main__":
@@ -1,10 +1,17 @@
 import os
+import sys
 import csv
-import time
 import argparse
-import requests
 from thefuzz import fuzz
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from common.checkpoint import DEFAULT_CHECKPOINT_EVERY, Checkpoint, add_checkpoint_arguments
+from common.async_enrichment import FetchError, add_engine_arguments, engine_options, enrich_rows
+
+RATE_LIMITS = {
+    'api.openalex.org': 5,
+}
+
 
 def parse_arguments():
     parser = argparse.ArgumentParser(
@@ -13,10 +20,12 @@ def parse_arguments():
                         help="Path to the input CSV file")
     parser.add_argument("-o", "--output_file",
                         help="Path to the output CSV file")
+    add_engine_arguments(parser)
+    add_checkpoint_arguments(parser)
     return parser.parse_args()
 
 
-def get_openalex_data(doi=None, title=None):
+async def get_openalex_data(engine, doi=None, title=None):
     base_url = "https://api.openalex.org/works"
     params = {}
     if doi:
@@ -26,13 +35,15 @@ def get_openalex_data(doi=None, title=None):
     else:
         return None
     try:
-        response = requests.get(base_url, params=params)
-        response.raise_for_status()
-        data = response.json()
-        return data["results"][0] if data["results"] else None
-    except requests.RequestException as e:
+        response = await engine.fetch(base_url, params=params)
+    except FetchError as e:
         print(f"API request failed: {e}")
         return None
+    if not response.ok:
+        print(f"API request failed: {response.status} for url: {response.url}")
+        return None
+    data = response.json()
+    return data["results"][0] if data["results"] else None
 
 
 def transform_name(name):
@@ -71,16 +82,16 @@ def extract_affiliations(matched_authors):
     return ";".join(affiliations), ";".join(ror_ids)
 
 
-def search_work(title):
-    return get_openalex_data(title=title)
+async def search_work(engine, title):
+    return await get_openalex_data(engine, title=title)
 
 
-def process_record(row):
+async def process_record(engine, row):
     result = row.copy()
     if row.get('JRNL_DOI') and row.get('COMMON_AUTHORS'):
-        work_data = get_openalex_data(doi=row['JRNL_DOI'])
+        work_data = await get_openalex_data(engine, doi=row['JRNL_DOI'])
     elif row.get('JRNL_TITL'):
-        work_data = search_work(row['JRNL_TITL'])
+        work_data = await search_work(engine, row['JRNL_TITL'])
     else:
         work_data = None
     if work_data:
@@ -96,21 +107,21 @@ def process_record(row):
         result['OpenAlex_ID'] = ""
         result['Author_Affiliations'] = ""
         result['ROR_IDs'] = ""
-    time.sleep(1)
     return result
 
 
-def process_and_write_iteratively(input_file, output_file):
+def process_and_write_iteratively(input_file, output_file, options, resume=False,
+                                  checkpoint_every=DEFAULT_CHECKPOINT_EVERY):
     with open(input_file, 'r', encoding='utf-8') as infile, \
-            open(output_file, 'w', encoding='utf-8') as outfile:
+            Checkpoint(output_file, input_file, resume, checkpoint_every,
+                       encoding='utf-8') as checkpoint:
         reader = csv.DictReader(infile)
         fieldnames = reader.fieldnames + \
             ['Retrieved_DOI', 'OpenAlex_ID', 'Author_Affiliations', 'ROR_IDs']
-        writer = csv.DictWriter(outfile, fieldnames=fieldnames)
-        writer.writeheader()
-        for row in reader:
-            processed_row = process_record(row)
-            writer.writerow(processed_row)
+        writer = csv.DictWriter(checkpoint.output, fieldnames=fieldnames)
+        if checkpoint.needs_header:
+            writer.writeheader()
+        enrich_rows(checkpoint.skip(reader), process_record, checkpoint.row_writer(writer), **options)
         print(f"Processing complete. Results written to {output_file}")
 
 
@@ -122,7 +133,9 @@ def main():
         input_file_base = os.path.splitext(args.input_file)[0]
         output_file = f"{input_file_base}_reconciled_w_openalex.csv"
 
-    process_and_write_iteratively(args.input_file, output_file)
+    process_and_write_iteratively(args.input_file, output_file,
+                                  engine_options(args, RATE_LIMITS),
+                                  args.resume, args.checkpoint_every)
 
 
 if __name__ == "__main__":
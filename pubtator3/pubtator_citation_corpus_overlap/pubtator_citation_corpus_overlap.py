@@ -1,16 +1,23 @@
+import os
+import sys
 import csv
 import math
 import time
 import requests
 import argparse
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from common.corpus_io import iter_rows, read_fieldnames
+
+ID_COLUMNS = [('subjId', 'objId'), ('dataset', 'publication')]
+
 
 def parse_arguments():
     parser = argparse.ArgumentParser(description="DOI Comparison System")
     parser.add_argument('-c', '--complete', required=True,
-                        help="Path to complete dataset CSV")
+                        help="Path to complete dataset CSV or Parquet file")
     parser.add_argument('-s', '--sample', required=True,
-                        help="Path to sample dataset CSV")
+                        help="Path to sample dataset CSV or Parquet file")
     parser.add_argument('-o', '--output', required=True,
                         help="Path to output summary CSV")
     return parser.parse_args()
@@ -54,19 +61,28 @@ def query_pubtator(subj_id):
     return dois
 
 
+def id_columns(file_path):
+    # Sample files carry subjId/objId. The combined corpus output names the
+    # same values dataset/publication
+    fieldnames = read_fieldnames(file_path)
+    for columns in ID_COLUMNS:
+        if all(column in fieldnames for column in columns):
+            return columns
+    raise KeyError(f"{file_path} has neither subjId/objId nor dataset/publication columns")
+
+
 def process_csv(file_path):
     result = {}
     doi_counts = {}
-    with open(file_path, 'r') as csvfile:
-        reader = csv.DictReader(csvfile)
-        for row in reader:
-            subj_id = row['subjId']
-            obj_id = row['objId']
-            if subj_id not in result:
-                result[subj_id] = set()
-                doi_counts[subj_id] = 0
-            result[subj_id].add(obj_id)
-            doi_counts[subj_id] += 1
+    subj_column, obj_column = id_columns(file_path)
+    for row in iter_rows(file_path, columns=[subj_column, obj_column]):
+        subj_id = row[subj_column]
+        obj_id = row[obj_column]
+        if subj_id not in result:
+            result[subj_id] = set()
+            doi_counts[subj_id] = 0
+        result[subj_id].add(obj_id)
+        doi_counts[subj_id] += 1
     return result, doi_counts
 
 
@@ -1,8 +1,51 @@
+import io
 import os
+import re
+import sys
 import csv
+import zlib
+import heapq
+import sqlite3
+import hashlib
 import logging
 import argparse
-from datetime import datetime
+import tempfile
+from sys import intern
+from functools import lru_cache
+from operator import itemgetter
+from datetime import datetime, timedelta, timezone
+from multiprocessing import Pool
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from common.corpus_io import import_pyarrow
+
+FIELDNAMES = ['id', 'created', 'updated', 'repository', 'publisher', 'journal', 'title',
+              'publication', 'dataset', 'publishedDate', 'source', 'subjects', 'affiliations', 'funders']
+# Records are tuples of (updated timestamp in microseconds, *FIELDNAMES values)
+DATASET_INDEX = FIELDNAMES.index('dataset')
+PUBLICATION_INDEX = FIELDNAMES.index('publication')
+UPDATED_INDEX = FIELDNAMES.index('updated')
+INTERNED_POSITIONS = [FIELDNAMES.index(field) + 1
+                      for field in ['repository', 'publisher', 'journal', 'source']]
+CREATED_POSITION = FIELDNAMES.index('created') + 1
+UPDATED_POSITION = UPDATED_INDEX + 1
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+ONE_MICROSECOND = timedelta(microseconds=1)
+ISO_TIMESTAMP = re.compile(r'\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d(\.\d{1,6})?(Z|[+-]\d\d:?\d\d)')
+# Rough in-memory size of a deduplicated row relative to its size on disk,
+# used to turn --max-memory into a number of on-disk buckets
+ROW_MEMORY_FACTOR = 3
+# Bucket files are only opened one at a time while partitioning, and at most
+# MERGE_FAN_IN sorted files are open at once while merging, so neither
+# depends on the open file limit
+MAX_BUCKETS = 16384
+MERGE_FAN_IN = 64
+HASH_CHUNK_SIZE = 1024 * 1024
+INDEX_LOOKUP_BATCH = 500
+PARQUET_BATCH_SIZE = 100000
+DICTIONARY_FIELDS = ['repository', 'publisher', 'journal', 'source']
+TIMESTAMP_FIELDS = ['created', 'updated']
+MEMORY_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
 
 
 def parse_arguments():
@@ -12,11 +55,30 @@ def parse_arguments():
                         help="Path to the input directory")
     parser.add_argument("-o", "--output_dir", default="combined_files",
                         help="Path to the output directory")
+    parser.add_argument("-w", "--workers", type=int, default=1,
+                        help="Number of worker processes used to read the CSV files")
+    parser.add_argument("-m", "--max-memory", dest="max_memory", type=parse_memory_size,
+                        help="Bound memory use by spilling rows to on-disk buckets, e.g. 4G or 512M")
+    parser.add_argument("--parquet", action="store_true",
+                        help="Also write a compressed, typed combined_output.parquet file")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Only process new CSV files and patch the existing combined output")
+    parser.add_argument("--index_file",
+                        help="Path to the incremental key index and file manifest (default: OUTPUT_DIR/combine_index.sqlite)")
     parser.add_argument("-v", "--verbose", action="store_true",
                         help="Enable verbose logging")
     return parser.parse_args()
 
 
+def parse_memory_size(value):
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([KMGT]?)B?\s*', value, re.IGNORECASE)
+    if not match:
+        raise argparse.ArgumentTypeError(
+            f"Invalid memory size: {value}. Use a number of bytes or a K/M/G/T suffix")
+    number, unit = match.groups()
+    return int(float(number) * MEMORY_UNITS[unit.upper()])
+
+
 def setup_logging(verbose):
     level = logging.DEBUG if verbose else logging.INFO
     logging.basicConfig(
@@ -49,34 +111,509 @@ def parse_date(date_string):
         return datetime.strptime(date_string, "%Y-%m-%dT%H:%M:%S%z")
 
 
-def process_files(csv_files, csv_output):
+@lru_cache(maxsize=65536)
+def parse_timestamp(date_string):
+    # fromisoformat parses the corpus timestamps in one call. Before Python
+    # 3.11 it rejects a Z suffix, offsets without a colon and fractions other
+    # than 3 or 6 digits, so those, and anything else outside the shapes both
+    # parsers agree on, go through parse_date
+    parsed = None
+    if ISO_TIMESTAMP.fullmatch(date_string):
+        try:
+            parsed = datetime.fromisoformat(date_string)
+        except ValueError:
+            pass
+    if parsed is None:
+        parsed = parse_date(date_string)
+    return (parsed - EPOCH) // ONE_MICROSECOND
+
+
+def read_rows(infile):
+    reader = csv.reader(infile)
+    header = next(reader, None)
+    if header is None:
+        return
+    columns = {name: i for i, name in enumerate(header)}
+    for field in ['dataset', 'publication', 'updated']:
+        if field not in columns:
+            raise KeyError(field)
+    width = len(header)
+    # Columns missing from the header point at the trailing '' appended to every row
+    get_values = itemgetter(*[columns.get(field, width) for field in FIELDNAMES])
+    for row in reader:
+        if not row:
+            continue
+        if len(row) != width:
+            row = row[:width] + [''] * (width - len(row))
+        row.append('')
+        values = get_values(row)
+        key = f"{normalize_doi(values[DATASET_INDEX])}|{normalize_doi(values[PUBLICATION_INDEX])}"
+        yield key, values
+
+
+def make_record(updated_ts, values):
+    record = [updated_ts]
+    record.extend(values)
+    for position in INTERNED_POSITIONS:
+        record[position] = intern(record[position])
+    # Most rows were never updated after creation, so share the one string
+    if record[CREATED_POSITION] == record[UPDATED_POSITION]:
+        record[CREATED_POSITION] = record[UPDATED_POSITION]
+    return tuple(record)
+
+
+def process_file(file, data_dict=None):
+    if data_dict is None:
+        data_dict = {}
+    logging.debug(f"Processing CSV file: {file}")
+    try:
+        with open(file, 'r', encoding='utf-8') as infile:
+            for key, values in read_rows(infile):
+                updated_ts = parse_timestamp(values[UPDATED_INDEX])
+                current = data_dict.get(key)
+                if current is None or updated_ts > current[0]:
+                    data_dict[key] = make_record(updated_ts, values)
+    except Exception as e:
+        logging.error(f"Error processing CSV file {file}: {str(e)}")
+    return data_dict
+
+
+def merge_partial(data_dict, partial):
+    # Partials must be merged in file order: a key keeps its first-seen position
+    # and ties on 'updated' keep the row from the earlier file, as in a serial run
+    for key, entry in partial.items():
+        if key not in data_dict or entry[0] > data_dict[key][0]:
+            data_dict[key] = entry
+
+
+def combine_files(csv_files, workers=1):
     data_dict = {}
     logging.info(f"Processing {len(csv_files)} CSV files")
+    if workers > 1:
+        logging.info(f"Using {workers} worker processes")
+        with Pool(processes=workers) as pool:
+            for partial in pool.imap(process_file, csv_files):
+                merge_partial(data_dict, partial)
+    else:
+        for file in csv_files:
+            process_file(file, data_dict)
+    return data_dict
+
+
+def write_output(data_dict, csv_output):
+    logging.info(f"Writing processed CSV data to {csv_output}")
+    with open(csv_output, 'w', encoding='utf-8') as outfile:
+        if data_dict:
+            writer = csv.writer(outfile)
+            writer.writerow(FIELDNAMES)
+            for record in data_dict.values():
+                writer.writerow(record[1:])
+
+
+def parquet_schema(pa):
+    fields = []
+    for field in FIELDNAMES:
+        if field in TIMESTAMP_FIELDS:
+            fields.append(pa.field(field, pa.timestamp('us', tz='UTC')))
+        elif field in DICTIONARY_FIELDS:
+            fields.append(pa.field(field, pa.dictionary(pa.int32(), pa.string())))
+        else:
+            fields.append(pa.field(field, pa.string()))
+    return pa.schema(fields)
+
+
+def created_timestamp(record, unparsed):
+    # Empty values are stored as null, like any other empty column. Values
+    # that cannot be parsed are stored as null too, and collected in
+    # `unparsed` so that write_parquet can report them
+    created = record[CREATED_POSITION]
+    if created == record[UPDATED_POSITION]:
+        return record[0]
+    if not created:
+        return None
+    try:
+        return parse_timestamp(created)
+    except (ValueError, TypeError):
+        unparsed.append(created)
+        return None
+
+
+def records_to_table(pa, schema, records, unparsed):
+    columns = []
+    for position, field in enumerate(FIELDNAMES, start=1):
+        if field == 'updated':
+            values = [record[0] for record in records]
+        elif field == 'created':
+            values = [created_timestamp(record, unparsed) for record in records]
+        else:
+            values = [record[position] for record in records]
+        if field in DICTIONARY_FIELDS:
+            columns.append(pa.array(values, pa.string()).dictionary_encode())
+        else:
+            columns.append(pa.array(values, schema.field(field).type))
+    return pa.Table.from_arrays(columns, schema=schema)
+
+
+def write_parquet(records, parquet_output):
+    pa = import_pyarrow()
+    logging.info(f"Writing Parquet data to {parquet_output}")
+    schema = parquet_schema(pa)
+    unparsed = []
+    with pa.parquet.ParquetWriter(parquet_output, schema, compression='zstd') as writer:
+        batch = []
+        for record in records:
+            batch.append(record)
+            if len(batch) == PARQUET_BATCH_SIZE:
+                writer.write_table(records_to_table(pa, schema, batch, unparsed))
+                batch = []
+        if batch:
+            writer.write_table(records_to_table(pa, schema, batch, unparsed))
+    if unparsed:
+        examples = ', '.join(repr(value) for value in unparsed[:5])
+        logging.warning(
+            f"{len(unparsed)} 'created' values could not be parsed as timestamps and are null in "
+            f"{parquet_output}; the CSV output keeps them as written (e.g. {examples})")
+
+
+def process_files(csv_files, csv_output, workers=1, parquet_output=None):
+    data_dict = combine_files(csv_files, workers)
+    write_output(data_dict, csv_output)
+    if parquet_output:
+        write_parquet(data_dict.values(), parquet_output)
+
+
+def estimate_bucket_count(csv_files, max_memory):
+    total_size = sum(os.path.getsize(file) for file in csv_files)
+    num_buckets = max(1, -(-total_size * ROW_MEMORY_FACTOR // max_memory))
+    if num_buckets > MAX_BUCKETS:
+        raise ValueError(
+            f"--max-memory {max_memory} bytes is too small for {total_size} bytes of input: "
+            f"it needs {num_buckets} buckets, more than the {MAX_BUCKETS} allowed")
+    return num_buckets
+
+
+def partition_buffer_size(max_memory):
+    # On-disk bytes of spilled rows held back before they are appended to
+    # their buckets, leaving half of the budget for the rest of the run
+    return max(1, max_memory // (2 * ROW_MEMORY_FACTOR))
+
+
+def flush_buckets(bucket_paths, pending):
+    for path, lines in zip(bucket_paths, pending):
+        if lines:
+            with open(path, 'a', encoding='utf-8', newline='') as f:
+                f.writelines(lines)
+            lines.clear()
+
+
+def partition_files(csv_files, bucket_paths, buffer_size):
+    # Each spilled row is prefixed with its global sequence number, key and
+    # parsed timestamp, so buckets can be deduplicated on their own and merged
+    # back in first-seen order. Rows are buffered per bucket and appended to
+    # the bucket files once buffer_size bytes are pending, one file at a time
+    for path in bucket_paths:
+        open(path, 'w', encoding='utf-8', newline='').close()
+    pending = [[] for _ in bucket_paths]
+    buffered = 0
+    line = io.StringIO()
+    writer = csv.writer(line)
+    seq = 0
     for file in csv_files:
-        logging.debug(f"Processing CSV file: {file}")
+        logging.debug(f"Partitioning CSV file: {file}")
         try:
             with open(file, 'r', encoding='utf-8') as infile:
-                reader = csv.DictReader(infile)
-                for row in reader:
-                    normalized_dataset = normalize_doi(row['dataset'])
-                    normalized_publication = normalize_doi(row['publication'])
-                    key = f"{normalized_dataset}|{normalized_publication}"
-                    updated = parse_date(row['updated'])
-                    if key not in data_dict or updated > parse_date(data_dict[key]['updated']):
-                        data_dict[key] = row
+                for key, values in read_rows(infile):
+                    updated_ts = parse_timestamp(values[UPDATED_INDEX])
+                    writer.writerow((seq, key, updated_ts) + values)
+                    text = line.getvalue()
+                    line.seek(0)
+                    line.truncate()
+                    pending[zlib.crc32(key.encode('utf-8')) % len(pending)].append(text)
+                    buffered += len(text)
+                    seq += 1
+                    if buffered >= buffer_size:
+                        flush_buckets(bucket_paths, pending)
+                        buffered = 0
         except Exception as e:
             logging.error(f"Error processing CSV file {file}: {str(e)}")
+    flush_buckets(bucket_paths, pending)
+    logging.info(f"Partitioned {seq} rows into {len(bucket_paths)} buckets")
+
+
+def dedupe_bucket(bucket_path, sorted_path):
+    bucket_dict = {}
+    with open(bucket_path, 'r', encoding='utf-8', newline='') as infile:
+        for row in csv.reader(infile):
+            key = row[1]
+            updated_ts = int(row[2])
+            current = bucket_dict.get(key)
+            if current is None:
+                bucket_dict[key] = (int(row[0]), make_record(updated_ts, row[3:]))
+            elif updated_ts > current[1][0]:
+                bucket_dict[key] = (current[0], make_record(updated_ts, row[3:]))
+    with open(sorted_path, 'w', encoding='utf-8', newline='') as outfile:
+        writer = csv.writer(outfile)
+        for first_seq, record in sorted(bucket_dict.values(), key=itemgetter(0)):
+            writer.writerow((first_seq,) + record[1:])
+    os.remove(bucket_path)
+    return len(bucket_dict)
+
 
+def merged_records(sorted_paths, write):
+    # Merges at most MERGE_FAN_IN sorted files by their sequence number
+    sorted_files = [open(path, 'r', encoding='utf-8', newline='')
+                    for path in sorted_paths]
+    try:
+        readers = [csv.reader(f) for f in sorted_files]
+        for record in heapq.merge(*readers, key=lambda record: int(record[0])):
+            write(record)
+    finally:
+        for f in sorted_files:
+            f.close()
+
+
+def merge_buckets(sorted_paths, csv_output, spill_dir):
+    # With more sorted files than MERGE_FAN_IN, groups of them are first
+    # merged into intermediate sorted files, until few enough are left
+    level = 0
+    while len(sorted_paths) > MERGE_FAN_IN:
+        merged_paths = []
+        for start in range(0, len(sorted_paths), MERGE_FAN_IN):
+            merged_path = os.path.join(spill_dir, f"merged_{level}_{len(merged_paths)}.csv")
+            with open(merged_path, 'w', encoding='utf-8', newline='') as outfile:
+                merged_records(sorted_paths[start:start + MERGE_FAN_IN], csv.writer(outfile).writerow)
+            for path in sorted_paths[start:start + MERGE_FAN_IN]:
+                os.remove(path)
+            merged_paths.append(merged_path)
+        sorted_paths = merged_paths
+        level += 1
     logging.info(f"Writing processed CSV data to {csv_output}")
     with open(csv_output, 'w', encoding='utf-8') as outfile:
-        if data_dict:
-            fieldnames = ['id', 'created', 'updated', 'repository', 'publisher', 'journal', 'title',
-                          'publication', 'dataset', 'publishedDate', 'source', 'subjects', 'affiliations', 'funders']
-            writer = csv.DictWriter(outfile, fieldnames=fieldnames)
-            writer.writeheader()
-            for row in data_dict.values():
-                writer.writerow({field: row.get(field, '')
-                                 for field in fieldnames})
+        writer = csv.writer(outfile)
+        header = [FIELDNAMES]
+
+        def write(record):
+            # The header is only written with the first row, as in write_output
+            if header:
+                writer.writerow(header.pop())
+            writer.writerow(record[1:])
+        merged_records(sorted_paths, write)
+
+
+def process_files_spilling(csv_files, csv_output, max_memory):
+    num_buckets = estimate_bucket_count(csv_files, max_memory)
+    logging.info(f"Processing {len(csv_files)} CSV files in {num_buckets} on-disk buckets")
+    spill_dir = tempfile.mkdtemp(prefix="combine_spill_", dir=os.path.dirname(csv_output))
+    try:
+        bucket_paths = [os.path.join(spill_dir, f"bucket_{i}.csv")
+                        for i in range(num_buckets)]
+        sorted_paths = [os.path.join(spill_dir, f"sorted_{i}.csv")
+                        for i in range(num_buckets)]
+        partition_files(csv_files, bucket_paths, partition_buffer_size(max_memory))
+        unique_rows = 0
+        for bucket_path, sorted_path in zip(bucket_paths, sorted_paths):
+            unique_rows += dedupe_bucket(bucket_path, sorted_path)
+        logging.info(f"Deduplicated buckets down to {unique_rows} rows")
+        merge_buckets(sorted_paths, csv_output, spill_dir)
+    finally:
+        for file in os.listdir(spill_dir):
+            os.remove(os.path.join(spill_dir, file))
+        os.rmdir(spill_dir)
+
+
+def build_output(csv_files, csv_output, workers=1, max_memory=None, parquet_output=None):
+    if max_memory:
+        if workers > 1:
+            logging.warning("--workers is ignored when --max-memory is set")
+        process_files_spilling(csv_files, csv_output, max_memory)
+        if parquet_output:
+            write_parquet(records_from_output(csv_output), parquet_output)
+    else:
+        process_files(csv_files, csv_output, workers, parquet_output)
+
+
+def open_index(index_path):
+    conn = sqlite3.connect(index_path)
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS manifest (
+            path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, sha256 TEXT);
+        CREATE TABLE IF NOT EXISTS keys (
+            key TEXT PRIMARY KEY, updated_ts INTEGER, ordinal INTEGER) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER);
+    """)
+    return conn
+
+
+def hash_file(file):
+    sha256 = hashlib.sha256()
+    with open(file, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def file_entry(file):
+    stat = os.stat(file)
+    return os.path.abspath(file), stat.st_size, stat.st_mtime_ns
+
+
+def scan_manifest(conn, csv_files):
+    manifest = {row[0]: row[1:] for row in conn.execute(
+        "SELECT path, size, mtime_ns, sha256 FROM manifest")}
+    new_files, changed_files, touched = [], [], []
+    for file in csv_files:
+        path, size, mtime_ns = file_entry(file)
+        if path not in manifest:
+            new_files.append(file)
+            continue
+        known_size, known_mtime_ns, known_sha256 = manifest.pop(path)
+        if (size, mtime_ns) == (known_size, known_mtime_ns):
+            continue
+        sha256 = hash_file(file) if size == known_size else None
+        if sha256 == known_sha256:
+            touched.append((path, size, mtime_ns, sha256))
+        else:
+            changed_files.append(file)
+    removed_files = list(manifest)
+    return new_files, changed_files, removed_files, touched
+
+
+def record_files(conn, csv_files):
+    conn.executemany(
+        "INSERT OR REPLACE INTO manifest (path, size, mtime_ns, sha256) VALUES (?, ?, ?, ?)",
+        [file_entry(file) + (hash_file(file),) for file in csv_files])
+
+
+def record_output(conn, csv_output):
+    stat = os.stat(csv_output)
+    conn.executemany("INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)",
+                     [('output_size', stat.st_size), ('output_mtime_ns', stat.st_mtime_ns)])
+
+
+def output_matches_index(conn, csv_output):
+    if not os.path.exists(csv_output):
+        return False
+    meta = dict(conn.execute("SELECT name, value FROM meta"))
+    stat = os.stat(csv_output)
+    return (meta.get('output_size'), meta.get('output_mtime_ns')) == (stat.st_size, stat.st_mtime_ns)
+
+
+def read_output(csv_output):
+    with open(csv_output, 'r', encoding='utf-8', newline='') as infile:
+        reader = csv.reader(infile)
+        next(reader, None)
+        yield from reader
+
+
+def records_from_output(csv_output):
+    for row in read_output(csv_output):
+        yield make_record(parse_timestamp(row[UPDATED_INDEX]), row)
+
+
+def rebuild_index(conn, csv_files, csv_output):
+    logging.info("Rebuilding incremental index from the combined output")
+    conn.execute("DELETE FROM manifest")
+    conn.execute("DELETE FROM keys")
+    conn.executemany(
+        "INSERT INTO keys (key, updated_ts, ordinal) VALUES (?, ?, ?)",
+        ((f"{normalize_doi(row[DATASET_INDEX])}|{normalize_doi(row[PUBLICATION_INDEX])}",
+          parse_timestamp(row[UPDATED_INDEX]), ordinal)
+         for ordinal, row in enumerate(read_output(csv_output))))
+    record_files(conn, csv_files)
+    record_output(conn, csv_output)
+    conn.commit()
+
+
+def lookup_keys(conn, keys):
+    known = {}
+    for i in range(0, len(keys), INDEX_LOOKUP_BATCH):
+        batch = keys[i:i + INDEX_LOOKUP_BATCH]
+        placeholders = ','.join('?' * len(batch))
+        for key, updated_ts, ordinal in conn.execute(
+                f"SELECT key, updated_ts, ordinal FROM keys WHERE key IN ({placeholders})", batch):
+            known[key] = (updated_ts, ordinal)
+    return known
+
+
+def patch_output(csv_output, replacements, appended):
+    if replacements:
+        logging.info(f"Rewriting {len(replacements)} superseded rows in {csv_output}")
+        patched_output = f"{csv_output}.tmp"
+        with open(patched_output, 'w', encoding='utf-8') as outfile:
+            writer = csv.writer(outfile)
+            writer.writerow(FIELDNAMES)
+            for ordinal, row in enumerate(read_output(csv_output)):
+                record = replacements.get(ordinal)
+                writer.writerow(record[1:] if record else row)
+            writer.writerows(record[1:] for record in appended)
+        os.replace(patched_output, csv_output)
+    elif appended:
+        logging.info(f"Appending {len(appended)} rows to {csv_output}")
+        write_header = os.path.getsize(csv_output) == 0
+        with open(csv_output, 'a', encoding='utf-8') as outfile:
+            writer = csv.writer(outfile)
+            if write_header:
+                writer.writerow(FIELDNAMES)
+            writer.writerows(record[1:] for record in appended)
+
+
+def apply_new_files(conn, new_files, csv_output, workers=1):
+    data_dict = combine_files(new_files, workers)
+    known = lookup_keys(conn, list(data_dict))
+    next_ordinal = conn.execute("SELECT COUNT(*) FROM keys").fetchone()[0]
+    replacements, appended, index_updates = {}, [], []
+    for key, record in data_dict.items():
+        if key not in known:
+            appended.append(record)
+            index_updates.append((key, record[0], next_ordinal))
+            next_ordinal += 1
+        elif record[0] > known[key][0]:
+            ordinal = known[key][1]
+            replacements[ordinal] = record
+            index_updates.append((key, record[0], ordinal))
+    patch_output(csv_output, replacements, appended)
+    conn.executemany(
+        "INSERT OR REPLACE INTO keys (key, updated_ts, ordinal) VALUES (?, ?, ?)", index_updates)
+    record_files(conn, new_files)
+    record_output(conn, csv_output)
+    conn.commit()
+    logging.info(f"Added {len(appended)} rows and replaced {len(replacements)} rows")
+
+
+def process_files_incremental(csv_files, csv_output, index_path, workers=1, max_memory=None,
+                              parquet_output=None):
+    conn = open_index(index_path)
+    try:
+        new_files, changed_files, removed_files, touched = scan_manifest(conn, csv_files)
+        if not output_matches_index(conn, csv_output):
+            reason = "combined output does not match the index"
+        elif changed_files or removed_files:
+            reason = f"{len(changed_files)} changed and {len(removed_files)} removed CSV files"
+        else:
+            reason = None
+        if reason:
+            # Rows from changed or removed files may have been winners, and the
+            # index does not keep the runners-up, so start again from scratch
+            logging.info(f"Full rebuild needed: {reason}")
+            build_output(csv_files, csv_output, workers, max_memory, parquet_output)
+            rebuild_index(conn, csv_files, csv_output)
+            return
+        conn.executemany(
+            "UPDATE manifest SET size = ?, mtime_ns = ? WHERE path = ?",
+            [(size, mtime_ns, path) for path, size, mtime_ns, _ in touched])
+        conn.commit()
+        if not new_files:
+            logging.info("No new CSV files, combined output is up to date")
+            if parquet_output and not os.path.exists(parquet_output):
+                write_parquet(records_from_output(csv_output), parquet_output)
+            return
+        logging.info(f"Processing {len(new_files)} new CSV files incrementally")
+        apply_new_files(conn, new_files, csv_output, workers)
+        if parquet_output:
+            # Parquet files cannot be patched in place, so rewrite it from the patched CSV
+            write_parquet(records_from_output(csv_output), parquet_output)
+    finally:
+        conn.close()
 
 
 def main():
@@ -91,7 +628,26 @@ def main():
     os.makedirs(args.output_dir, exist_ok=True)
     logging.info(f"Output directory set to: {args.output_dir}")
     csv_output = os.path.join(args.output_dir, "combined_output.csv")
-    process_files(csv_files, csv_output)
+    parquet_output = None
+    if args.parquet:
+        try:
+            import_pyarrow()
+        except ImportError as e:
+            logging.error(str(e))
+            return
+        parquet_output = os.path.join(args.output_dir, "combined_output.parquet")
+    try:
+        if args.incremental:
+            index_path = args.index_file or os.path.join(
+                args.output_dir, "combine_index.sqlite")
+            process_files_incremental(csv_files, csv_output, index_path, args.workers,
+                                      args.max_memory, parquet_output)
+        else:
+            build_output(csv_files, csv_output, args.workers,
+                         args.max_memory, parquet_output)
+    except ValueError as e:
+        logging.error(str(e))
+        return
     logging.info("All files processed.")
 
 
@@ -0,0 +1,49 @@
+import unittest
+from unittest import mock
+
+import combine_dcc_csv_files as combine
+
+TIMESTAMPS = [
+    '2024-01-01T00:00:00Z',
+    '2024-01-01T00:00:00+0000',
+    '2024-01-01T00:00:00+00:00',
+    '2024-01-01T12:30:45.5Z',
+    '2024-01-01T12:30:45.12345+0130',
+    '2024-01-01T12:30:45.123456-05:00',
+]
+
+
+class FromIsoformatBefore311(combine.datetime):
+    # fromisoformat as on Python 3.10, which only accepts +HH:MM offsets and
+    # 3 or 6 digit fractions
+    @classmethod
+    def fromisoformat(cls, date_string):
+        fraction = date_string[20:].split('+')[0].split('-')[0] if date_string[19:20] == '.' else ''
+        if date_string.endswith('Z') or date_string[-3] != ':' or len(fraction) not in (0, 3, 6):
+            raise ValueError(f'Invalid isoformat string: {date_string!r}')
+        return super().fromisoformat(date_string)
+
+
+def expected(date_string):
+    return (combine.parse_date(date_string) - combine.EPOCH) // combine.ONE_MICROSECOND
+
+
+class ParseTimestampTest(unittest.TestCase):
+    def setUp(self):
+        combine.parse_timestamp.cache_clear()
+
+    def tearDown(self):
+        combine.parse_timestamp.cache_clear()
+
+    def test_matches_parse_date(self):
+        for date_string in TIMESTAMPS:
+            self.assertEqual(combine.parse_timestamp(date_string), expected(date_string), date_string)
+
+    def test_falls_back_when_fromisoformat_rejects(self):
+        with mock.patch.object(combine, 'datetime', FromIsoformatBefore311):
+            for date_string in TIMESTAMPS:
+                self.assertEqual(combine.parse_timestamp(date_string), expected(date_string), date_string)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+import os
+import sys
+import csv
+import time
+import uuid
+import random
+import argparse
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from combine_dcc_csv_files import (FIELDNAMES, discover_files, normalize_doi,
+                                   parse_date, parse_timestamp, process_file)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the combine/dedupe loop against the dict-per-row baseline")
+    parser.add_argument("-i", "--input_dir",
+                        help="DCC release directory with a 'csv' subdirectory (synthetic data is generated if omitted)")
+    parser.add_argument("-n", "--num_rows", type=int, default=200000,
+                        help="Number of synthetic rows to generate")
+    parser.add_argument("-o", "--output", help="Output file path for results")
+    return parser.parse_args()
+
+
+def generate_release(base_dir, num_rows, num_files=10):
+    csv_dir = os.path.join(base_dir, "csv")
+    os.makedirs(csv_dir, exist_ok=True)
+    repositories = ['Gene Expression Omnibus', 'European Nucleotide Archive',
+                    'Protein Data Bank', 'Zenodo', 'Dryad', '']
+    rows_per_file = num_rows // num_files
+    for i in range(num_files):
+        with open(os.path.join(csv_dir, f"part_{i}.csv"), 'w', encoding='utf-8', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=FIELDNAMES)
+            writer.writeheader()
+            for _ in range(rows_per_file):
+                updated = f"2024-0{random.randint(1, 9)}-1{random.randint(0, 9)}T12:{random.randint(10, 59)}:{random.randint(10, 59)}.{random.randint(0, 999):03d}+00:00"
+                writer.writerow({
+                    'id': str(uuid.uuid4()),
+                    'created': updated,
+                    'updated': updated,
+                    'repository': random.choice(repositories),
+                    'publisher': random.choice(['Elsevier', 'Springer Nature', 'Wiley']),
+                    'journal': random.choice(['Nature', 'Cell', 'PLoS ONE', '']),
+                    'title': 'Sample dataset title',
+                    'publication': f"https://doi.org/10.1000/pub.{random.randint(0, num_rows // 4)}",
+                    'dataset': f"https://doi.org/10.5061/dataset.{random.randint(0, 4)}",
+                    'publishedDate': '2023-01-01T00:00:00+00:00',
+                    'source': random.choice(['eupmc', 'datacite', 'czi']),
+                    'subjects': 'biology;genomics',
+                    'affiliations': 'University of Somewhere',
+                    'funders': ''
+                })
+
+
+def baseline_process_file(file, data_dict):
+    with open(file, 'r', encoding='utf-8') as infile:
+        reader = csv.DictReader(infile)
+        for row in reader:
+            normalized_dataset = normalize_doi(row['dataset'])
+            normalized_publication = normalize_doi(row['publication'])
+            key = f"{normalized_dataset}|{normalized_publication}"
+            updated = parse_date(row['updated'])
+            if key not in data_dict or updated > parse_date(data_dict[key]['updated']):
+                data_dict[key] = row
+    return data_dict
+
+
+def run(process, csv_files, measure_memory):
+    data_dict = {}
+    parse_timestamp.cache_clear()
+    if measure_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    for file in csv_files:
+        process(file, data_dict)
+    elapsed = time.perf_counter() - start
+    retained = 0
+    if measure_memory:
+        retained = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+    return elapsed, len(data_dict), retained
+
+
+def count_rows(csv_files):
+    total = 0
+    for file in csv_files:
+        with open(file, 'r', encoding='utf-8') as f:
+            total += sum(1 for _ in csv.DictReader(f))
+    return total
+
+
+def format_results(total_rows, results):
+    lines = [f"Input rows: {total_rows}"]
+    for name, (elapsed, unique_rows, retained) in results.items():
+        lines.append(f"{name}: {total_rows / elapsed:,.0f} rows/sec, "
+                     f"{retained / unique_rows:,.0f} bytes/row retained ({unique_rows} unique rows)")
+    baseline, compact = results['dict rows'], results['compact records']
+    lines.append(f"Speedup: {baseline[0] / compact[0]:.2f}x, "
+                 f"memory reduction: {baseline[2] / compact[2]:.2f}x")
+    return '\n'.join(lines) + '\n'
+
+
+def main():
+    args = parse_args()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        input_dir = args.input_dir
+        if not input_dir:
+            input_dir = tmp_dir
+            generate_release(input_dir, args.num_rows)
+        csv_files = discover_files(input_dir)
+        total_rows = count_rows(csv_files)
+        results = {}
+        for name, process in [('dict rows', baseline_process_file), ('compact records', process_file)]:
+            elapsed = run(process, csv_files, False)[0]
+            _, unique_rows, retained = run(process, csv_files, True)
+            results[name] = (elapsed, unique_rows, retained)
+    results = format_results(total_rows, results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(results)
+    else:
+        print(results)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,69 +1,199 @@
+import os
+import sys
 import csv
 import argparse
-from collections import Counter
+from collections import Counter, deque
+from multiprocessing import Pool
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from common.corpus_io import is_parquet, iter_rows
+
+DIMENSIONS = {
+    'repository': ['repository'],
+    'publisher': ['publisher'],
+    'journal': ['journal'],
+    'source': ['source'],
+    'repository_source': ['repository', 'source'],
+}
+CHUNK_SIZE = 50000
 
 
 def parse_arguments():
     parser = argparse.ArgumentParser(
         description='Count repositories from CSV file and calculate percentages')
     parser.add_argument('-i', '--input_file',
-                        help='Path to the input CSV file')
+                        help='Path to the input CSV or Parquet file')
     parser.add_argument('-o', '--output_file',
                         help='Path to the output CSV file')
+    parser.add_argument('-d', '--dimensions', nargs='+', choices=list(DIMENSIONS),
+                        default=['repository'],
+                        help='Columns to count in the same pass (default: repository)')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='Number of worker processes used to count CSV chunks')
+    parser.add_argument('-c', '--chunk_size', type=int, default=CHUNK_SIZE,
+                        help='Number of rows per chunk')
     return parser.parse_args()
 
 
-def read_csv(file_path):
-    with open(file_path, 'r', encoding='utf-8') as file:
-        reader = csv.DictReader(file)
-        data = list(reader)
-    return data
+def required_columns(dimensions):
+    columns = []
+    for dimension in dimensions:
+        for column in DIMENSIONS[dimension]:
+            if column not in columns:
+                columns.append(column)
+    return columns
+
+
+def count_records(records, positions):
+    # positions maps each dimension to the record positions of its columns;
+    # values are stripped and a row only counts when none of them is empty
+    counters = {dimension: Counter() for dimension in positions}
+    for record in records:
+        for dimension, columns in positions.items():
+            if len(columns) == 1:
+                value = record[columns[0]].strip()
+                if value:
+                    counters[dimension][value] += 1
+            else:
+                values = tuple(record[column].strip() for column in columns)
+                if all(values):
+                    counters[dimension][values] += 1
+    return counters
+
+
+def count_chunk(task):
+    lines, positions = task
+    width = max(column for columns in positions.values() for column in columns) + 1
+    records = (record for record in csv.reader(lines) if record)
+    return count_records((record + [''] * (width - len(record)) if len(record) < width else record
+                          for record in records), positions)
+
+
+def iter_csv_chunks(file, chunk_size):
+    # Splits the file into chunks of whole CSV records without parsing them: a
+    # record continues onto the next line while its count of '"' is odd
+    lines = []
+    records = 0
+    quotes = 0
+    for line in file:
+        lines.append(line)
+        quotes += line.count('"')
+        if quotes % 2 == 0:
+            quotes = 0
+            records += 1
+            if records == chunk_size:
+                yield lines
+                lines = []
+                records = 0
+    if lines:
+        yield lines
+
+
+def imap_bounded(pool, func, tasks, window):
+    pending = deque()
+    for task in tasks:
+        pending.append(pool.apply_async(func, (task,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
 
 
-def process_repositories(data):
-    repo_counter = Counter()
-    for row in data:
-        repo = row['repository'].strip()
-        if repo:
-            repo_counter[repo] += 1
-    total_count = sum(repo_counter.values())
-    repo_data = [
-        {
-            'repository': repo,
-            'count': count,
-            'percent_total': count / total_count if total_count > 0 else 0
-        }
-        for repo, count in repo_counter.items()
-    ]
-    repo_data.sort(key=lambda x: x['count'], reverse=True)
+def merge_counters(totals, partial):
+    for dimension, counter in partial.items():
+        totals[dimension].update(counter)
 
-    return repo_data
 
+def count_csv(file_path, dimensions, workers=1, chunk_size=CHUNK_SIZE):
+    totals = {dimension: Counter() for dimension in dimensions}
+    with open(file_path, 'r', encoding='utf-8', newline='') as file:
+        header = next(csv.reader(file), [])
+        columns = {name: i for i, name in enumerate(header)}
+        for column in required_columns(dimensions):
+            if column not in columns:
+                raise KeyError(column)
+        positions = {dimension: [columns[column] for column in DIMENSIONS[dimension]]
+                     for dimension in dimensions}
+        tasks = ((lines, positions) for lines in iter_csv_chunks(file, chunk_size))
+        if workers > 1:
+            with Pool(processes=workers) as pool:
+                for partial in imap_bounded(pool, count_chunk, tasks, workers * 2):
+                    merge_counters(totals, partial)
+        else:
+            for task in tasks:
+                merge_counters(totals, count_chunk(task))
+    return totals
 
-def write_csv(file_path, data):
+
+def count_parquet(file_path, dimensions, chunk_size=CHUNK_SIZE):
+    columns = required_columns(dimensions)
+    positions = {dimension: [columns.index(column) for column in DIMENSIONS[dimension]]
+                 for dimension in dimensions}
+    totals = {dimension: Counter() for dimension in dimensions}
+    records = []
+    for row in iter_rows(file_path, columns=columns):
+        records.append([row[column] for column in columns])
+        if len(records) == chunk_size:
+            merge_counters(totals, count_records(records, positions))
+            records = []
+    merge_counters(totals, count_records(records, positions))
+    return totals
+
+
+def count_dimensions(file_path, dimensions, workers=1, chunk_size=CHUNK_SIZE):
+    if is_parquet(file_path):
+        return count_parquet(file_path, dimensions, chunk_size)
+    return count_csv(file_path, dimensions, workers, chunk_size)
+
+
+def process_dimension(dimension, counter):
+    columns = DIMENSIONS[dimension]
+    total_count = sum(counter.values())
+    dimension_data = []
+    for value, count in counter.items():
+        values = value if len(columns) > 1 else (value,)
+        row = dict(zip(columns, values))
+        row['count'] = count
+        row['percent_total'] = count / total_count if total_count > 0 else 0
+        dimension_data.append(row)
+    dimension_data.sort(key=lambda x: x['count'], reverse=True)
+    return dimension_data
+
+
+def write_csv(file_path, data, columns):
     if data:
-        fieldnames = ['repository', 'count', 'percent_total']
+        fieldnames = columns + ['count', 'percent_total']
         with open(file_path, 'w', encoding='utf-8') as file:
             writer = csv.DictWriter(file, fieldnames=fieldnames)
             writer.writeheader()
             writer.writerows(data)
 
 
+def get_output_file(output_file, dimension, dimensions):
+    if len(dimensions) == 1:
+        return output_file
+    base, ext = os.path.splitext(output_file)
+    return f"{base}_{dimension}{ext or '.csv'}"
+
+
 def main():
     args = parse_arguments()
     input_file = args.input_file
     output_file = args.output_file
     try:
-        data = read_csv(input_file)
-        repo_data = process_repositories(data)
-        write_csv(output_file, repo_data)
-        print(f"Repository list with counts and correct percentages written to: {output_file}")
+        counters = count_dimensions(
+            input_file, args.dimensions, args.workers, args.chunk_size)
+        for dimension in args.dimensions:
+            dimension_file = get_output_file(output_file, dimension, args.dimensions)
+            write_csv(dimension_file, process_dimension(dimension, counters[dimension]),
+                      DIMENSIONS[dimension])
+            print(f"{dimension.capitalize()} list with counts and correct percentages written to: {dimension_file}")
     except FileNotFoundError:
         print(f"Input file not found: {input_file}")
     except IOError:
         print(f"An error occurred while reading or writing the file.")
-    except KeyError:
-        print(f"The 'repository' column was not found in the CSV file.")
+    except KeyError as e:
+        print(f"The '{e.args[0]}' column was not found in the input file.")
 
 
 if __name__ == '__main__':
@@ -3,19 +3,39 @@ import re
 import argparse
 import sys
 import os
-from datetime import datetime
+from array import array
+from itertools import chain
+from contextlib import ExitStack
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from common.corpus_io import is_parquet, iter_rows, read_fieldnames
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+ONE_MICROSECOND = timedelta(microseconds=1)
 
 
 def parse_arguments():
     parser = argparse.ArgumentParser(
         description='Validate dataset in CSV file based on repository and regex pattern.')
     parser.add_argument('-i', '--input_file',
-                        required=True, help='Input CSV file')
-    parser.add_argument('-r', '--repository', required=True,
+                        required=True, help='Input CSV or Parquet file')
+    parser.add_argument('-r', '--repository',
                         help='Repository name to filter')
-    parser.add_argument('-p', '--pattern', required=True,
+    parser.add_argument('-p', '--pattern',
                         help='Regex pattern for dataset validation')
-    return parser.parse_args()
+    parser.add_argument('-g', '--registry',
+                        help='CSV file with repository and pattern columns, validated in a single pass')
+    parser.add_argument('-o', '--output_dir', default='.',
+                        help='Directory for the output files')
+    parser.add_argument('-l', '--low_memory', action='store_true',
+                        help='Keep only key, timestamp and byte offset per row and re-read winners in a second pass (CSV input only)')
+    args = parser.parse_args()
+    if not args.registry and not (args.repository and args.pattern):
+        parser.error('either --registry or both --repository and --pattern are required')
+    if args.low_memory and is_parquet(args.input_file):
+        parser.error('--low_memory requires a CSV input file')
+    return args
 
 
 def is_valid_dataset(dataset, pattern):
@@ -44,43 +64,219 @@ def parse_date(date_string):
         return datetime.strptime(date_string, "%Y-%m-%dT%H:%M:%S%z")
 
 
-def process_csv(input_file, repository, pattern):
+def parse_timestamp(date_string):
+    return (parse_date(date_string) - EPOCH) // ONE_MICROSECOND
+
+
+def load_registry(registry_file):
+    # Output files are named after the normalized repository name, so two
+    # repositories that normalize alike would write to the same files
+    registry = {}
+    prefixes = {}
+    with open(registry_file, 'r', encoding='utf-8', newline='') as f:
+        for row in csv.DictReader(f):
+            repository = row['repository']
+            if repository in registry:
+                raise ValueError(f"Repository listed more than once in registry: {repository}")
+            prefix = normalize_repository_name(repository)
+            if prefix in prefixes:
+                raise ValueError(f"Repositories {prefixes[prefix]!r} and {repository!r} in registry "
+                                 f"would both write {prefix}_valid.csv and {prefix}_invalid.csv")
+            prefixes[prefix] = repository
+            registry[repository] = row['pattern']
+    return registry
+
+
+def select_latest_rows(input_file, repositories):
+    unique_pairs = {repository: {} for repository in repositories}
+    for row in iter_rows(input_file):
+        repository_pairs = unique_pairs.get(row['repository'])
+        if repository_pairs is None:
+            continue
+        normalized_publication = normalize_doi(row['publication'])
+        normalized_dataset = normalize_doi(row['dataset'])
+        key = (normalized_publication, normalized_dataset)
+        current_date = parse_date(row['updated'])
+        if key not in repository_pairs or current_date > parse_date(repository_pairs[key]['updated']):
+            repository_pairs[key] = row
+    return unique_pairs
+
+
+def iter_records_with_offsets(f):
+    # Yields (byte offset, raw bytes) for every CSV record; a record continues
+    # onto the next line while its count of '"' is odd
+    offset = f.tell()
+    start = offset
+    lines = []
+    quotes = 0
+    for line in f:
+        if not lines:
+            start = offset
+        lines.append(line)
+        offset += len(line)
+        quotes += line.count(b'"')
+        if quotes % 2 == 0:
+            yield start, b''.join(lines)
+            lines = []
+            quotes = 0
+    if lines:
+        yield start, b''.join(lines)
+
+
+def parse_record(raw):
+    return next(csv.reader([raw.decode('utf-8')]), [])
+
+
+def to_row(fieldnames, values):
+    row = dict(zip(fieldnames, values))
+    for field in fieldnames[len(values):]:
+        row[field] = None
+    return row
+
+
+def select_latest_offsets(input_file, repositories):
+    # First pass: per repository, each key maps to a slot in two fixed-size
+    # arrays holding the winning row's updated timestamp and byte offset
+    slots = {repository: {} for repository in repositories}
+    updated = array('q')
+    offsets = array('q')
+    with open(input_file, 'rb') as f:
+        records = iter_records_with_offsets(f)
+        fieldnames = next((parse_record(raw) for _, raw in records), [])
+        for offset, raw in records:
+            values = parse_record(raw)
+            if not values:
+                continue
+            row = to_row(fieldnames, values)
+            repository_slots = slots.get(row['repository'])
+            if repository_slots is None:
+                continue
+            key = f"{normalize_doi(row['publication'])}|{normalize_doi(row['dataset'])}"
+            current_ts = parse_timestamp(row['updated'])
+            slot = repository_slots.get(key)
+            if slot is None:
+                repository_slots[key] = len(offsets)
+                updated.append(current_ts)
+                offsets.append(offset)
+            elif current_ts > updated[slot]:
+                updated[slot] = current_ts
+                offsets[slot] = offset
+    return fieldnames, array('q', sorted(offsets))
+
+
+def iter_rows_at_offsets(input_file, fieldnames, offsets):
+    # Second pass: stream the file again and only parse the winning records
+    next_index = 0
+    with open(input_file, 'rb') as f:
+        for offset, raw in iter_records_with_offsets(f):
+            if next_index == len(offsets):
+                break
+            if offset == offsets[next_index]:
+                next_index += 1
+                yield to_row(fieldnames, parse_record(raw))
+
+
+def select_rows(input_file, repositories, low_memory=False):
+    if low_memory:
+        fieldnames, offsets = select_latest_offsets(input_file, repositories)
+        return fieldnames, iter_rows_at_offsets(input_file, fieldnames, offsets)
+    fieldnames = read_fieldnames(input_file)
+    unique_pairs = select_latest_rows(input_file, repositories)
+    return fieldnames, chain.from_iterable(
+        repository_pairs.values() for repository_pairs in unique_pairs.values())
+
+
+def get_output_files(repository, output_dir):
     normalized_prefix = normalize_repository_name(repository)
-    valid_output = f"{normalized_prefix}_valid.csv"
-    invalid_output = f"{normalized_prefix}_invalid.csv"
-    try:
-        with open(input_file, 'r') as infile:
-            reader = csv.DictReader(infile)
-            fieldnames = reader.fieldnames
-            unique_pairs = {}
-            for row in reader:
-                if row['repository'] == repository:
-                    normalized_publication = normalize_doi(row['publication'])
-                    normalized_dataset = normalize_doi(row['dataset'])
-                    key = (normalized_publication, normalized_dataset)
-                    current_date = parse_date(row['updated'])
-                    if key not in unique_pairs or current_date > parse_date(unique_pairs[key]['updated']):
-                        unique_pairs[key] = row
-        with open(valid_output, 'w') as valid_file, open(invalid_output, 'w') as invalid_file:
+    valid_output = os.path.join(output_dir, f"{normalized_prefix}_valid.csv")
+    invalid_output = os.path.join(output_dir, f"{normalized_prefix}_invalid.csv")
+    return valid_output, invalid_output
+
+
+def write_validation_outputs(rows, patterns, fieldnames, output_dir):
+    counts = {repository: [0, 0] for repository in patterns}
+    with ExitStack() as stack:
+        writers = {}
+        for repository in patterns:
+            valid_output, invalid_output = get_output_files(repository, output_dir)
+            valid_file = stack.enter_context(open(valid_output, 'w'))
+            invalid_file = stack.enter_context(open(invalid_output, 'w'))
             valid_writer = csv.DictWriter(valid_file, fieldnames=fieldnames)
             invalid_writer = csv.DictWriter(
                 invalid_file, fieldnames=fieldnames)
             valid_writer.writeheader()
             invalid_writer.writeheader()
-            for (publication, normalized_dataset), row in unique_pairs.items():
-                if is_valid_dataset(row['dataset'], pattern):
-                    valid_writer.writerow(row)
-                else:
-                    invalid_writer.writerow(row)
+            writers[repository] = (valid_writer, invalid_writer)
+        for row in rows:
+            repository = row['repository']
+            valid_writer, invalid_writer = writers[repository]
+            if is_valid_dataset(row['dataset'], patterns[repository]):
+                valid_writer.writerow(row)
+                counts[repository][0] += 1
+            else:
+                invalid_writer.writerow(row)
+                counts[repository][1] += 1
+    return counts
+
+
+def write_summary(summary_file, summary):
+    fieldnames = ['repository', 'pattern', 'unique_rows', 'valid', 'invalid',
+                  'percent_valid', 'valid_output', 'invalid_output']
+    with open(summary_file, 'w') as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames)
+        writer.writeheader()
+        writer.writerows(summary)
+
+
+def process_csv(input_file, repository, pattern, output_dir='.', low_memory=False):
+    valid_output, invalid_output = get_output_files(repository, output_dir)
+    try:
+        fieldnames, rows = select_rows(input_file, [repository], low_memory)
+        write_validation_outputs(rows, {repository: pattern}, fieldnames, output_dir)
         print(f"Processing complete. Valid rows written to {valid_output}, invalid rows written to {invalid_output}")
     except IOError as e:
         print(f"An error occurred while processing the file: {e}", file=sys.stderr)
         sys.exit(1)
 
 
+def process_registry(input_file, registry_file, output_dir='.', low_memory=False):
+    try:
+        registry = load_registry(registry_file)
+        patterns = {repository: re.compile(pattern)
+                    for repository, pattern in registry.items()}
+        fieldnames, rows = select_rows(input_file, registry, low_memory)
+        counts = write_validation_outputs(rows, patterns, fieldnames, output_dir)
+        summary = []
+        for repository, (valid_count, invalid_count) in counts.items():
+            valid_output, invalid_output = get_output_files(repository, output_dir)
+            total = valid_count + invalid_count
+            summary.append({
+                'repository': repository,
+                'pattern': registry[repository],
+                'unique_rows': total,
+                'valid': valid_count,
+                'invalid': invalid_count,
+                'percent_valid': valid_count / total if total > 0 else 0,
+                'valid_output': valid_output,
+                'invalid_output': invalid_output
+            })
+        summary_file = os.path.join(output_dir, 'validation_summary.csv')
+        write_summary(summary_file, summary)
+        print(f"Processing complete. Validated {len(registry)} repositories, summary written to {summary_file}")
+    except (IOError, ValueError, re.error) as e:
+        print(f"An error occurred while processing the file: {e}", file=sys.stderr)
+        sys.exit(1)
+
+
 def main():
     args = parse_arguments()
-    process_csv(args.input_file, args.repository, args.pattern)
+    os.makedirs(args.output_dir, exist_ok=True)
+    if args.registry:
+        process_registry(args.input_file, args.registry,
+                         args.output_dir, args.low_memory)
+    else:
+        process_csv(args.input_file, args.repository,
+                    args.pattern, args.output_dir, args.low_memory)
 
 
 if __name__ == "__main__":
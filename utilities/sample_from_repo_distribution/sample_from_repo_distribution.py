@@ -1,12 +1,26 @@
+import io
 import os
+import sys
 import csv
 import json
+import math
+import zlib
+import random
 import logging
 import argparse
+from multiprocessing import Pool
 import numpy as np
 import pandas as pd
 from datetime import datetime
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from common.corpus_io import iter_dataframes, iter_rows, read_dataframe, read_fieldnames
+
+LOW_CARDINALITY_COLUMNS = ['repository', 'publisher', 'journal', 'source']
+LEAN_CHUNK_SIZE = 100000
+SAMPLE_GROUPS = ['High (>10%)', 'Medium (1-10%)', 'Low (0.1-1%)',
+                 'Very Low (<0.1%)', 'Unspecified', 'Random']
+
 logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s - %(levelname)s - %(message)s')
 
@@ -15,7 +29,7 @@ def parse_arguments():
     parser = argparse.ArgumentParser(
         description='Sample DCC data and convert to JSON')
     parser.add_argument('-i', '--input_file',
-                        help='Path to the main data CSV file')
+                        help='Path to the main data CSV or Parquet file')
     parser.add_argument('-r', '--repo_distribution_file',
                         help='Path to the repository distribution CSV file')
     parser.add_argument('-o', '--output_dir', default="sample",
@@ -24,12 +38,55 @@ def parse_arguments():
                         help='Number of samples to take per group')
     parser.add_argument('-n', '--num_files', type=int, default=1,
                         help='Number of sample files to create per group')
-    return parser.parse_args()
+    parser.add_argument('-m', '--mode', choices=['pandas', 'streaming', 'lean'], default='pandas',
+                        help='pandas loads the whole input; streaming reads it once and keeps only one reservoir per group and file; lean picks rows from the repository column and then loads only those rows (default: pandas)')
+    parser.add_argument('-c', '--chunk_size', type=int, default=LEAN_CHUNK_SIZE,
+                        help=f'Rows per chunk when reading the input in lean mode (default: {LEAN_CHUNK_SIZE})')
+    parser.add_argument('-f', '--json_format', choices=['json', 'ndjson'], default='json',
+                        help='json writes one indented array per sample; ndjson writes one record per line (default: json)')
+    parser.add_argument('--seed', type=int,
+                        help='Seed that makes every (group, file) sample reproducible on its own')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='Number of processes writing sample files (default: 1)')
+    parser.add_argument('-g', '--group', action='append',
+                        help='Only write samples for this group, e.g. "High (>10%%)", High_(>10%%) or Random. Can be repeated')
+    parser.add_argument('-x', '--file_index', type=int, action='append',
+                        help='Only write the sample file with this 1-based index. Can be repeated')
+    args = parser.parse_args()
+    if args.group:
+        known = {name: name for name in SAMPLE_GROUPS}
+        known.update({name.replace(' ', '_'): name for name in SAMPLE_GROUPS})
+        unknown = [group for group in args.group if group not in known]
+        if unknown:
+            parser.error(f"unknown group(s) {', '.join(unknown)}; choose from {', '.join(SAMPLE_GROUPS)}")
+        args.group = [known[group] for group in args.group]
+    if args.file_index and not all(1 <= index <= args.num_files for index in args.file_index):
+        parser.error(f'--file_index must be between 1 and --num_files ({args.num_files})')
+    return args
+
+
+def sample_rng(seed, group_name, index):
+    # Each (group, file index) pair gets its own generator, so any one sample
+    # can be regenerated without drawing the others
+    if seed is None:
+        return np.random.default_rng()
+    return np.random.default_rng([seed, zlib.crc32(group_name.encode('utf-8')), index])
+
+
+def pair_filter(groups=None, file_indices=None):
+    def selected(group_name, index):
+        return ((not groups or group_name in groups) and
+                (not file_indices or index + 1 in file_indices))
+    return selected
+
+
+def select_all(group_name, index):
+    return True
 
 
 def load_data(file_path):
     try:
-        df = pd.read_csv(file_path)
+        df = read_dataframe(file_path)
         logging.info(f"Successfully loaded data from {file_path}")
         return df
     except Exception as e:
@@ -77,74 +134,284 @@ def group_repositories(repo_df):
     return groups
 
 
-def sample_data(data_df, repo_groups, samples_per_group, num_files):
+def draw_samples(group_data, group_name, samples_per_group, num_files,
+                 seed=None, selected=select_all, shuffle=False):
+    samples = []
+    for i in range(num_files):
+        if not selected(group_name, i):
+            samples.append(None)
+        elif len(group_data) <= samples_per_group and not shuffle:
+            samples.append(group_data)
+        else:
+            samples.append(group_data.sample(n=min(len(group_data), samples_per_group),
+                                             random_state=sample_rng(seed, group_name, i)))
+    return samples
+
+
+def sample_data(data_df, repo_groups, samples_per_group, num_files, seed=None, selected=select_all):
     sampled_data = {}
     unspecified_repos_data = data_df[data_df['repository'].isna() | (
         data_df['repository'].str.strip() == '')]
     if not unspecified_repos_data.empty:
-        sampled_data['Unspecified'] = [unspecified_repos_data.sample(
-            n=min(len(unspecified_repos_data), samples_per_group)) for _ in range(num_files)]
+        sampled_data['Unspecified'] = draw_samples(
+            unspecified_repos_data, 'Unspecified', samples_per_group, num_files,
+            seed, selected, shuffle=True)
         logging.info(f"Created {num_files} samples for 'Unspecified' repository group")
     for group_name, repos in repo_groups.items():
         if group_name == 'Unspecified':
             continue
         group_data = data_df[data_df['repository'].isin(repos)]
+        sampled_data[group_name] = draw_samples(
+            group_data, group_name, samples_per_group, num_files, seed, selected)
         if len(group_data) <= samples_per_group:
-            sampled_data[group_name] = [group_data] * num_files
             logging.info(f"Group {group_name}: Using all {len(group_data)} available samples for each file")
         else:
-            sampled_data[group_name] = [group_data.sample(
-                n=samples_per_group) for _ in range(num_files)]
             logging.info(f"Group {group_name}: Created {num_files} samples, each with {samples_per_group} samples out of {len(group_data)} available")
     return sampled_data
 
 
-def create_random_sample(data_df, samples_per_group, num_files):
-    random_samples = []
-    for _ in range(num_files):
-        random_sample = data_df.sample(n=min(len(data_df), samples_per_group))
-        random_samples.append(random_sample)
+def load_group_ids(file_path, group_names, repo_groups, chunk_size):
+    # One int8 group id per input row, read from the repository column alone;
+    # -1 marks rows whose repository is in no group
+    repo_to_group = {}
+    for index, group_name in enumerate(group_names):
+        for repo in repo_groups.get(group_name, []):
+            repo_to_group.setdefault(repo, index)
+    unspecified = group_names.index('Unspecified')
+    group_ids = []
+    for chunk in iter_dataframes(file_path, columns=['repository'], chunk_size=chunk_size,
+                                 dtype={'repository': 'category'}):
+        repository = chunk['repository'].astype('category')
+        lookup = [unspecified if str(category).strip() == '' else repo_to_group.get(category, -1)
+                  for category in repository.cat.categories]
+        # Missing values have code -1, which picks the trailing Unspecified entry
+        lookup = np.array(lookup + [unspecified], dtype=np.int8)
+        group_ids.append(lookup[repository.cat.codes.to_numpy()])
+    if not group_ids:
+        return np.empty(0, dtype=np.int8)
+    return np.concatenate(group_ids)
+
+
+def choose_positions(positions, group_name, samples_per_group, num_files,
+                     seed=None, selected=select_all, shuffle=False):
+    chosen = []
+    n = min(len(positions), samples_per_group)
+    for i in range(num_files):
+        if not selected(group_name, i):
+            chosen.append(None)
+        elif len(positions) <= samples_per_group and not shuffle:
+            chosen.append(positions)
+        else:
+            chosen.append(sample_rng(seed, group_name, i).choice(positions, size=n, replace=False))
+    return chosen
+
+
+def load_rows_at(file_path, positions, chunk_size):
+    # Second pass: read every column, keeping only the chosen rows from each chunk
+    fieldnames = read_fieldnames(file_path)
+    dtype = {column: 'category' for column in LOW_CARDINALITY_COLUMNS if column in fieldnames}
+    wanted = np.unique(np.concatenate(positions)) if positions else np.empty(0, dtype=np.int64)
+    frames = []
+    start = 0
+    if len(wanted):
+        for chunk in iter_dataframes(file_path, chunk_size=chunk_size, dtype=dtype):
+            stop = start + len(chunk)
+            low, high = np.searchsorted(wanted, [start, stop])
+            if high > low:
+                selected = chunk.iloc[wanted[low:high] - start]
+                selected.index = wanted[low:high]
+                frames.append(selected)
+            start = stop
+            if start > wanted[-1]:
+                break
+    if not frames:
+        return pd.DataFrame(columns=fieldnames)
+    rows = pd.concat(frames)
+    for column in dtype:
+        rows[column] = rows[column].astype('category')
+    return rows
+
+
+def sample_data_lean(file_path, repo_groups, samples_per_group, num_files, chunk_size,
+                     seed=None, selected=select_all):
+    group_names = ['Unspecified'] + \
+        [group_name for group_name in repo_groups if group_name != 'Unspecified']
+    group_ids = load_group_ids(file_path, group_names, repo_groups, chunk_size)
+    logging.info(f"Loaded repository groups for {len(group_ids)} rows from {file_path}")
+    chosen = {}
+    for index, group_name in enumerate(group_names):
+        positions = np.flatnonzero(group_ids == index)
+        if group_name == 'Unspecified' and not len(positions):
+            continue
+        chosen[group_name] = choose_positions(positions, group_name, samples_per_group, num_files,
+                                              seed, selected, shuffle=group_name == 'Unspecified')
+        logging.info(f"Group {group_name}: Chose {num_files} samples, each with {min(len(positions), samples_per_group)} samples out of {len(positions)} available")
+    random_positions = choose_positions(np.arange(len(group_ids)), 'Random', samples_per_group,
+                                        num_files, seed, selected, shuffle=True)
+    logging.info(f"Chose {num_files} random samples, each with {samples_per_group} samples out of {len(group_ids)} available")
+    all_positions = [p for samples in chosen.values() for p in samples] + random_positions
+    rows = load_rows_at(file_path, [p for p in all_positions if p is not None], chunk_size)
+    logging.info(f"Loaded {len(rows)} sampled rows from {file_path}")
+    sampled_data = {group_name: [None if p is None else rows.loc[p] for p in samples]
+                    for group_name, samples in chosen.items()}
+    random_samples = [None if p is None else rows.loc[p] for p in random_positions]
+    return sampled_data, random_samples
+
+
+def create_random_sample(data_df, samples_per_group, num_files, seed=None, selected=select_all):
+    random_samples = draw_samples(data_df, 'Random', samples_per_group, num_files,
+                                  seed, selected, shuffle=True)
     logging.info(f"Created {num_files} random samples, each with {samples_per_group} samples out of {len(data_df)} available")
     return random_samples
 
 
-def create_nested_object(data, keys):
-    for key in keys:
-        if key in data and pd.notna(data[key]):
-            return {
-                "title": data[key],
-                "external_id": None
-            }
-    return None
-
-
-def convert_to_array(value):
-    if pd.isna(value):
-        return []
-    return [item.strip() for item in str(value).split(';') if item.strip()]
-
-
-def transform_row(row):
-    def replace_nan(value):
-        return None if pd.isna(value) else value
-    transformed = {
-        "id": replace_nan(row.get("id")),
-        "created": replace_nan(row.get("created")),
-        "updated": replace_nan(row.get("updated")),
-        "repository": create_nested_object(row, ["repository"]),
-        "publisher": create_nested_object(row, ["publisher"]),
-        "journal": create_nested_object(row, ["journal"]),
-        "title": replace_nan(row.get("title")),
-        # Changed from objId
-        "publication": replace_nan(row.get("publication")),
-        "dataset": replace_nan(row.get("dataset")),  # Changed from subjId
-        "publishedDate": replace_nan(row.get("publishedDate")),
-        "source": replace_nan(row.get("source")),
-        "affiliations": convert_to_array(row.get("affiliations")),
-        "funders": convert_to_array(row.get("funders")),
-        "subjects": convert_to_array(row.get("subjects"))
-    }
-    return transformed
+class Reservoir:
+    # Algorithm L reservoir sampling: after the reservoir fills, jump straight
+    # to the next stream index that replaces an item instead of drawing per row
+    __slots__ = ('size', 'items', 'weight', 'next_index', 'rng')
+
+    def __init__(self, size, rng=None):
+        self.size = size
+        self.items = []
+        self.rng = rng or random.Random()
+        self.weight = 1.0
+        self.next_index = size - 1
+        if size > 0:
+            self.advance()
+
+    def uniform(self):
+        value = self.rng.random()
+        while value == 0.0:
+            value = self.rng.random()
+        return value
+
+    def advance(self):
+        self.weight *= math.exp(math.log(self.uniform()) / self.size)
+        self.next_index += math.floor(
+            math.log(self.uniform()) / math.log1p(-self.weight)) + 1
+
+    def offer(self, index, item):
+        if index < self.size:
+            self.items.append(item)
+        elif index == self.next_index:
+            self.items[self.rng.randrange(self.size)] = item
+            self.advance()
+
+
+def is_unspecified(repository):
+    return repository is None or repository.strip() == ''
+
+
+def reservoir_rng(seed, group_name, index):
+    if seed is None:
+        return random.Random()
+    return random.Random(int(sample_rng(seed, group_name, index).integers(2**63)))
+
+
+def stream_samples(file_path, repo_groups, samples_per_group, num_files,
+                   seed=None, selected=select_all):
+    repo_to_group = {}
+    for group_name, repos in repo_groups.items():
+        for repo in repos:
+            repo_to_group.setdefault(repo, group_name)
+    group_names = ['Unspecified'] + \
+        [group_name for group_name in repo_groups if group_name != 'Unspecified']
+    reservoirs = {group_name: [Reservoir(samples_per_group, reservoir_rng(seed, group_name, i))
+                               if selected(group_name, i) else None for i in range(num_files)]
+                  for group_name in group_names + ['Random']}
+    active = {group_name: [reservoir for reservoir in group_reservoirs if reservoir is not None]
+              for group_name, group_reservoirs in reservoirs.items()}
+    seen = dict.fromkeys(reservoirs, 0)
+    for row in iter_rows(file_path):
+        repository = row.get('repository')
+        if is_unspecified(repository):
+            group_name = 'Unspecified'
+        else:
+            group_name = repo_to_group.get(repository)
+        for name in (group_name, 'Random'):
+            if name is None:
+                continue
+            index = seen[name]
+            for reservoir in active[name]:
+                reservoir.offer(index, row)
+            seen[name] = index + 1
+    logging.info(f"Streamed {seen['Random']} rows from {file_path}")
+    return reservoirs, seen
+
+
+def rows_to_dataframe(rows, fieldnames):
+    # Round-trip through read_csv so sampled rows get the same dtypes and
+    # missing-value handling as the pandas mode
+    if not fieldnames:
+        return pd.DataFrame()
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=fieldnames, extrasaction='ignore')
+    writer.writeheader()
+    writer.writerows(rows)
+    buffer.seek(0)
+    return pd.read_csv(buffer)
+
+
+def reservoir_frames(reservoirs, fieldnames):
+    return [None if reservoir is None else rows_to_dataframe(reservoir.items, fieldnames)
+            for reservoir in reservoirs]
+
+
+def sample_data_streaming(file_path, repo_groups, samples_per_group, num_files,
+                          seed=None, selected=select_all):
+    fieldnames = read_fieldnames(file_path)
+    reservoirs, seen = stream_samples(
+        file_path, repo_groups, samples_per_group, num_files, seed, selected)
+    sampled_data = {}
+    for group_name, group_reservoirs in reservoirs.items():
+        if group_name == 'Random' or (group_name == 'Unspecified' and not seen[group_name]):
+            continue
+        sampled_data[group_name] = reservoir_frames(group_reservoirs, fieldnames)
+        logging.info(f"Group {group_name}: Created {num_files} samples, each with {min(seen[group_name], samples_per_group)} samples out of {seen[group_name]} available")
+    random_samples = reservoir_frames(reservoirs['Random'], fieldnames)
+    logging.info(f"Created {num_files} random samples, each with {samples_per_group} samples out of {seen['Random']} available")
+    return sampled_data, random_samples
+
+
+SCALAR_FIELDS = ['id', 'created', 'updated']
+NESTED_FIELDS = ['repository', 'publisher', 'journal']
+TRAILING_SCALAR_FIELDS = ['title', 'publication', 'dataset', 'publishedDate', 'source']
+ARRAY_FIELDS = ['affiliations', 'funders', 'subjects']
+OUTPUT_FIELDS = SCALAR_FIELDS + NESTED_FIELDS + TRAILING_SCALAR_FIELDS + ARRAY_FIELDS
+
+
+def column_values(df, column):
+    # Whole column as Python objects with missing values as None
+    if column not in df.columns:
+        return [None] * len(df)
+    series = df[column]
+    return series.astype(object).where(series.notna(), None).tolist()
+
+
+def create_nested_objects(values):
+    return [None if value is None else {"title": value, "external_id": None}
+            for value in values]
+
+
+def convert_to_arrays(values):
+    arrays = []
+    for value in values:
+        if value is None:
+            arrays.append([])
+        else:
+            items = [item.strip() for item in str(value).split(';')]
+            arrays.append([item for item in items if item])
+    return arrays
+
+
+def transform_frame(df):
+    columns = [column_values(df, field) for field in SCALAR_FIELDS]
+    columns += [create_nested_objects(column_values(df, field))
+                for field in NESTED_FIELDS]
+    columns += [column_values(df, field) for field in TRAILING_SCALAR_FIELDS]
+    columns += [convert_to_arrays(column_values(df, field))
+                for field in ARRAY_FIELDS]
+    return [dict(zip(OUTPUT_FIELDS, values)) for values in zip(*columns)]
 
 
 class NpEncoder(json.JSONEncoder):
@@ -158,48 +425,101 @@ class NpEncoder(json.JSONEncoder):
         return super(NpEncoder, self).default(obj)
 
 
-def write_json(data, file_path):
+def write_json(records, file_path):
+    # Same bytes as json.dump(list(records), indent=2), but written one record at a time
+    encoder = NpEncoder(indent=2, ensure_ascii=False)
     try:
         with open(file_path, 'w', encoding='utf-8') as jsonfile:
-            json.dump(data, jsonfile, indent=2,
-                      ensure_ascii=False, cls=NpEncoder)
+            separator = '[\n  '
+            for record in records:
+                jsonfile.write(separator)
+                jsonfile.write(encoder.encode(record).replace('\n', '\n  '))
+                separator = ',\n  '
+            jsonfile.write('[]' if separator == '[\n  ' else '\n]')
         logging.info(f"JSON data has been written to {file_path}")
     except IOError as e:
         logging.error(f"Error writing to JSON file: {e}")
         raise
 
 
-def generate_output(sampled_data, output_dir):
-    os.makedirs(output_dir, exist_ok=True)
+def write_ndjson(records, file_path):
+    encoder = NpEncoder(ensure_ascii=False)
+    try:
+        with open(file_path, 'w', encoding='utf-8') as jsonfile:
+            for record in records:
+                jsonfile.write(encoder.encode(record))
+                jsonfile.write('\n')
+        logging.info(f"NDJSON data has been written to {file_path}")
+    except IOError as e:
+        logging.error(f"Error writing to NDJSON file: {e}")
+        raise
+
+
+def write_sample(task):
+    group_dir, i, sample_df, json_format = task
+    csv_file_name = f"sample_{i+1}.csv"
+    json_file_name = f"sample_{i+1}.{json_format}"
+    csv_file_path = os.path.join(group_dir, csv_file_name)
+    json_file_path = os.path.join(group_dir, json_file_name)
+    sample_df.to_csv(csv_file_path, index=False)
+    logging.info(f"Saved CSV sample to {csv_file_path}")
+    transformed_data = transform_frame(sample_df)
+    if json_format == 'ndjson':
+        write_ndjson(transformed_data, json_file_path)
+    else:
+        write_json(transformed_data, json_file_path)
+    logging.info(f"Saved JSON sample to {json_file_path}")
+
+
+def output_tasks(sampled_data, output_dir, json_format='json'):
+    # Samples left as None were filtered out and are not written
+    tasks = []
     for group_name, samples in sampled_data.items():
         group_dir = os.path.join(output_dir, group_name.replace(' ', '_'))
-        os.makedirs(group_dir, exist_ok=True)
         for i, sample_df in enumerate(samples):
-            csv_file_name = f"sample_{i+1}.csv"
-            json_file_name = f"sample_{i+1}.json"
-            csv_file_path = os.path.join(group_dir, csv_file_name)
-            json_file_path = os.path.join(group_dir, json_file_name)
-            sample_df.to_csv(csv_file_path, index=False)
-            logging.info(f"Saved CSV sample to {csv_file_path}")
-            transformed_data = [transform_row(row)
-                                for _, row in sample_df.iterrows()]
-            write_json(transformed_data, json_file_path)
-            logging.info(f"Saved JSON sample to {json_file_path}")
+            if sample_df is None:
+                continue
+            os.makedirs(group_dir, exist_ok=True)
+            tasks.append((group_dir, i, sample_df, json_format))
+    return tasks
+
+
+def write_samples(tasks, workers=1):
+    if workers > 1 and len(tasks) > 1:
+        with Pool(processes=min(workers, len(tasks))) as pool:
+            for _ in pool.imap_unordered(write_sample, tasks):
+                pass
+    else:
+        for task in tasks:
+            write_sample(task)
 
 
 def main():
     args = parse_arguments()
     try:
-        data_df = load_data(args.input_file)
+        selected = pair_filter(args.group, args.file_index)
         repo_df = load_repo_distribution(args.repo_distribution_file)
         repo_groups = group_repositories(repo_df)
-        sampled_data = sample_data(
-            data_df, repo_groups, args.samples_per_group, args.num_files)
-        generate_output(sampled_data, args.output_dir)
-        random_samples = create_random_sample(
-            data_df, args.samples_per_group, args.num_files)
+        if args.mode == 'streaming':
+            sampled_data, random_samples = sample_data_streaming(
+                args.input_file, repo_groups, args.samples_per_group, args.num_files,
+                args.seed, selected)
+        elif args.mode == 'lean':
+            sampled_data, random_samples = sample_data_lean(
+                args.input_file, repo_groups, args.samples_per_group, args.num_files,
+                args.chunk_size, args.seed, selected)
+        else:
+            data_df = load_data(args.input_file)
+            sampled_data = sample_data(
+                data_df, repo_groups, args.samples_per_group, args.num_files,
+                args.seed, selected)
+            random_samples = create_random_sample(
+                data_df, args.samples_per_group, args.num_files, args.seed, selected)
         random_output_dir = os.path.join(args.output_dir, "Random_Sample")
-        generate_output({"Random": random_samples}, random_output_dir)
+        os.makedirs(args.output_dir, exist_ok=True)
+        tasks = output_tasks(sampled_data, args.output_dir, args.json_format)
+        tasks += output_tasks({"Random": random_samples}, random_output_dir, args.json_format)
+        write_samples(tasks, args.workers)
 
         logging.info(
             "Data sampling, CSV saving, and JSON serialization completed successfully")